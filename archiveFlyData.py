@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+
+
+'''
+append many fly scan files into one columnar HDF5 archive, query it by scan number
+
+Each PV of the configuration (saveFlyData.xml) becomes one column, at the
+same HDF5 path as in the fly scan files, with a leading scan axis:
+
+* scalar PVs: one extendable dataset, one row per scan
+  (numbers as float64, NaN if missing; text as variable-length strings)
+* array PVs: a group (attribute ``layout="ragged"``) with ``values``, all
+  scans concatenated, and ``offsets``: scan i is ``values[offsets[i]:offsets[i+1]]``;
+  ``errors`` keeps the text of a scan that holds no numbers (such as an error message)
+
+A PV is an array if the configuration says so (``length_limit``, ``stream``,
+or chunked/compressed storage) or as soon as any scan holds more than one
+value: a scalar column is then converted to a ragged one, keeping its earlier rows.
+
+The scans are listed in ``/scans`` (``scan_number``, ``file_name``, ``timestamp``).
+The scan number is the last number in the file name, such as 11 in
+``S5_FlyScan_0011.h5`` (or the row, if the name has no number)::
+
+  archiveFlyData.py archive.h5 /data/*FlyScan*.h5
+  archiveFlyData.py archive.h5 --query /entry/flyScan/mca_channels --scans 11,12
+'''
+
+
+import os
+import re
+
+import h5py
+import numpy
+
+import saveFlyData
+
+
+SCANS_GROUP = '/scans'
+RAGGED_LAYOUT = 'ragged'
+
+
+class FlyScanArchive(object):
+    '''many fly scans in one HDF5 file, one column per PV of the configuration'''
+
+    def __init__(self, archive_file, configuration, mode = 'a'):
+        self.configuration = configuration
+        self.file = h5py.File(archive_file, mode)
+        if SCANS_GROUP not in self.file and mode != 'r':
+            self.file.attrs['creator'] = __file__
+            self.file.attrs['creator_config_file'] = configuration.config_file
+            scans = self.file.create_group(SCANS_GROUP)
+            scans.create_dataset('scan_number', (0,), dtype='int64', maxshape=(None,))
+            for name in ('file_name', 'timestamp'):
+                scans.create_dataset(name, (0,), dtype=h5py.special_dtype(vlen=str),
+                                     maxshape=(None,))
+        self._rows = None
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        '''number of scans in the archive'''
+        return len(self.file[SCANS_GROUP + '/scan_number'])
+
+    def scan_numbers(self):
+        '''scan numbers, in order of the rows'''
+        return numpy.array(self.file[SCANS_GROUP + '/scan_number'])
+
+    def row(self, scan_number):
+        '''row of a scan number, raise KeyError if it is not in the archive'''
+        if self._rows is None:
+            self._rows = dict([(int(n), i) for i, n in enumerate(self.scan_numbers())])
+        return self._rows[int(scan_number)]
+
+    def append(self, scan_file, scan_number = None):
+        '''
+        append one fly scan file, return its scan number
+
+        The columns are written first and the row in ``/scans`` last,
+        so the rows of an interrupted append are written again by the next one.
+        '''
+        n = len(self)
+        if scan_number is None:
+            scan_number = scan_number_from_name(scan_file, n)
+        if scan_number in self:
+            raise KeyError, 'scan %d is already in the archive' % scan_number
+        with h5py.File(scan_file, 'r') as scan:
+            for path in sorted(self.configuration.pvs):
+                value = None
+                if path in scan and isinstance(scan[path], h5py.Dataset):
+                    value = numpy.array(scan[path])
+                self._append_value(path, value, n)
+            timestamp = str(scan.attrs.get('timestamp', ''))
+
+        scans = self.file[SCANS_GROUP]
+        for name, value in (('scan_number', scan_number),
+                            ('file_name', os.path.abspath(scan_file)),
+                            ('timestamp', timestamp)):
+            scans[name].resize((n + 1,))
+            scans[name][n] = value
+        self.file.flush()
+        self._rows = None
+        return scan_number
+
+    def __contains__(self, scan_number):
+        '''is this scan number in the archive?'''
+        try:
+            self.row(scan_number)
+        except KeyError:
+            return False
+        return True
+
+    def scalar(self, hdf5_path, scan_numbers = None):
+        '''values of a scalar column for these scan numbers (default: all scans)'''
+        column = self.file[hdf5_path]
+        if column.attrs.get('layout') == RAGGED_LAYOUT:
+            raise RuntimeError, 'not a scalar column: ' + hdf5_path
+        values = numpy.array(column[:len(self)])
+        if scan_numbers is None:
+            return values
+        return values[[self.row(n) for n in scan_numbers]]
+
+    def array(self, hdf5_path, scan_number):
+        '''array of one scan from a ragged (array) column'''
+        column = self.file[hdf5_path]
+        if column.attrs.get('layout') != RAGGED_LAYOUT:
+            return self.scalar(hdf5_path, [scan_number])
+        i = self.row(scan_number)
+        start, stop = column['offsets'][i:i+2]
+        return numpy.array(column['values'][start:stop])
+
+    def _append_value(self, path, value, n):
+        '''write the value of one scan at row n of its column (create the column first)'''
+        if path not in self.file:
+            if value is None:
+                return      # column is created (with earlier rows missing) when data arrive
+            self._create_column(path, value, n)
+        column = self.file[path]
+        is_ragged = column.attrs.get('layout') == RAGGED_LAYOUT
+        if not is_ragged and value is not None and value.size > 1 and value.dtype.kind in 'biuf':
+            column = self._make_ragged(path, column, value.dtype, n)
+            is_ragged = True
+        if is_ragged:
+            self._append_ragged(column, value, n)
+        else:
+            column.resize((n + 1,))
+            column[n] = self._scalar(column, value)
+
+    def _create_column(self, path, value, n):
+        parent = self.file.require_group(path.rsplit('/', 1)[0] or '/')
+        name = path.rsplit('/', 1)[1]
+        numeric = value.dtype.kind in 'biuf'
+        if value.size > 1 or self._is_array_pv(path):
+            dtype = value.dtype if numeric else 'float64'
+            column = self._create_ragged(parent, name, dtype, n)
+        elif numeric:
+            column = parent.create_dataset(name, (n,), dtype='float64', maxshape=(None,),
+                                           chunks=True, fillvalue=numpy.nan)
+        else:
+            column = parent.create_dataset(name, (n,), dtype=h5py.special_dtype(vlen=str),
+                                           maxshape=(None,), chunks=True)
+        column.attrs['epics_pv'] = self.configuration.pvs[path].pvname
+
+    def _is_array_pv(self, path):
+        '''does the configuration make this PV an array (whatever one scan holds)?'''
+        pv_spec = self.configuration.pvs[path]
+        array_storage = set(('chunks', 'compression', 'shuffle')) & set(pv_spec.storage)
+        return pv_spec.length_limit is not None or pv_spec.stream or len(array_storage) > 0
+
+    def _create_ragged(self, parent, name, dtype, n):
+        '''new ragged column, earlier scans (before the column existed) are empty'''
+        column = parent.create_group(name)
+        column.attrs['layout'] = RAGGED_LAYOUT
+        column.create_dataset('values', (0,), dtype=dtype,
+                              maxshape=(None,), chunks=True, compression='gzip')
+        column.create_dataset('offsets', (n + 1,), dtype='int64',
+                              maxshape=(None,), chunks=True)
+        column.create_dataset('errors', (n,), dtype=h5py.special_dtype(vlen=str),
+                              maxshape=(None,), chunks=True)
+        return column
+
+    def _make_ragged(self, path, column, dtype, n):
+        '''replace a scalar column by a ragged one with the same n rows'''
+        old = numpy.array(column[:n])
+        attrs = dict(column.attrs)
+        parent, name = column.parent, path.rsplit('/', 1)[1]
+        del parent[name]
+        if old.dtype.kind == 'f':
+            dtype = numpy.promote_types(dtype, old.dtype)
+        column = self._create_ragged(parent, name, dtype, 0)
+        for key, value in attrs.items():
+            column.attrs[key] = value
+        for i, value in enumerate(old):
+            if old.dtype.kind == 'f' and not numpy.isnan(value):
+                self._append_ragged(column, numpy.array([value]), i)
+            elif old.dtype.kind == 'f' or value == '':
+                self._append_ragged(column, None, i)
+            else:
+                self._append_ragged(column, numpy.array([value]), i)    # kept as error text
+        print 'column %s: now ragged (an array arrived at row %d)' % (path, n)
+        return column
+
+    def _scalar(self, column, value):
+        '''one value to fit the type of a scalar column'''
+        if value is not None and value.size > 0:
+            value = value.flat[0]
+        elif column.dtype.kind == 'f':
+            return numpy.nan
+        else:
+            return ''
+        if column.dtype.kind == 'f':
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return numpy.nan        # such as "not connected"
+        return str(value)
+
+    def _append_ragged(self, column, value, n):
+        offsets, values = column['offsets'], column['values']
+        end = offsets[n]
+        error = ''
+        if value is not None and value.dtype.kind not in 'biuf':
+            error = ' '.join([str(v) for v in value.ravel()])   # such as an error message
+            value = None
+        if value is None:
+            value = numpy.array([], dtype=values.dtype)
+        value = value.ravel()
+        if not numpy.can_cast(value.dtype, values.dtype):
+            values = self._widen(column, numpy.promote_types(value.dtype, values.dtype))
+        if 'errors' in column:      # not in archives made before the errors were kept
+            column['errors'].resize((n + 1,))
+            column['errors'][n] = error
+        values.resize((end + len(value),))
+        values[end:] = value
+        offsets.resize((n + 2,))
+        offsets[n + 1] = end + len(value)
+
+    def _widen(self, column, dtype):
+        '''rewrite the values of a ragged column with a wider dtype, return the new dataset'''
+        old = numpy.array(column['values']).astype(dtype)
+        del column['values']
+        return column.create_dataset('values', data=old, dtype=dtype,
+                                     maxshape=(None,), chunks=True, compression='gzip')
+
+
+def scan_number_from_name(file_name, default):
+    '''last number in the base name of the file, default if there is none'''
+    numbers = re.findall(r'\d+', os.path.splitext(os.path.basename(file_name))[0])
+    if len(numbers) == 0:
+        return default
+    return int(numbers[-1])
+
+
+def report(archive, paths, scan_numbers = None):
+    '''print the scalar columns as a table, one row per scan'''
+    if scan_numbers is None:
+        scan_numbers = list(archive.scan_numbers())
+    columns = [archive.scalar(path, scan_numbers) for path in paths]
+    print '\t'.join(['scan'] + paths)
+    for i, scan_number in enumerate(scan_numbers):
+        print '\t'.join([str(scan_number)] + [str(column[i]) for column in columns])
+
+
+def get_CLI_options():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('archive_file',
+                    action='store',
+                    help="HDF5 archive file (created if it does not exist)")
+
+    parser.add_argument('scan_files',
+                    action='store',
+                    nargs='*',
+                    help="fly scan HDF5 files to append to the archive")
+
+    parser.add_argument('--config',
+                    action='store',
+                    default=saveFlyData.XML_CONFIGURATION_FILE,
+                    help="XML configuration file, default: " + saveFlyData.XML_CONFIGURATION_FILE)
+
+    parser.add_argument('--query',
+                    action='append',
+                    default=[],
+                    help="HDF5 path of a scalar PV to report (may be given more than once)")
+
+    parser.add_argument('--scans',
+                    action='store',
+                    default=None,
+                    help="comma-separated scan numbers to report, default: all")
+
+    return parser.parse_args()
+
+
+def main():
+    cli_options = get_CLI_options()
+    configuration = saveFlyData.ScanConfiguration(cli_options.config)
+    mode = 'a'
+    if len(cli_options.scan_files) == 0:
+        mode = 'r'
+    archive = FlyScanArchive(cli_options.archive_file, configuration, mode)
+    try:
+        for scan_file in cli_options.scan_files:
+            try:
+                scan_number = archive.append(scan_file)
+            except KeyError, exc:
+                print 'not archived: %s: %s' % (scan_file, exc)
+                continue
+            print 'archived scan %d: %s' % (scan_number, scan_file)
+        if len(cli_options.query) > 0:
+            scan_numbers = None
+            if cli_options.scans is not None:
+                scan_numbers = [int(n) for n in cli_options.scans.split(',')]
+            report(archive, cli_options.query, scan_numbers)
+    finally:
+        archive.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+
+'''
+benchmark saveFlyData.py against simulated EPICS PVs (no IOCs needed)
+
+For each number of MCA channels, a complete fly scan save is run
+with the simEpics backend and these are reported:
+
+* connect: time to connect all PVs (seconds)
+* prelim: time to write the preliminary data (seconds)
+* post-scan: time from trigger Done to file closed (seconds)
+* throughput: MCA array data written per second of post-scan time (MB/s)
+'''
+
+
+import os
+import shutil
+import tempfile
+
+import saveFlyData
+import simEpics
+
+
+DEFAULT_CHANNELS = (1000, 8000, 32000, 100000)
+
+
+def run_one(configuration, scenario, h5_file, cache_file, streaming = False):
+    '''save one simulated fly scan, return dictionary of timings'''
+    backend = simEpics.SimulatedBackend(scenario)
+    cache = saveFlyData.EpicsMetadataCache(cache_file)
+
+    sfs = saveFlyData.SaveFlyScan(None, metadata_cache=cache,
+                                  configuration=configuration, backend=backend)
+    sfs.streaming = streaming
+
+    sfs.newFile(h5_file)
+    sfs.waitForData()
+    phases = sfs.timings.phases()      # as written in the diagnostics group of the file
+    timings = {}
+    timings['connect'] = phases['connect']
+    timings['prelim'] = phases['preliminary']
+    timings['post-scan'] = sfs.trigger_to_close_s
+    array_bytes = scenario['channels'] * 4 * len(backend.scenario['arrays'])
+    timings['throughput'] = array_bytes / 1e6 / max(sfs.trigger_to_close_s, 1e-9)
+    timings['PVs'] = len(configuration.pvs)
+    timings['file bytes'] = os.path.getsize(h5_file)
+    return timings
+
+
+def benchmark(config_file, channel_counts, scenario = None, streaming = False):
+    '''run the simulated fly scan for each number of channels, return [(channels, timings)]'''
+    configuration = saveFlyData.ScanConfiguration(config_file)
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cache_file = os.path.join(tmp_dir, 'metadata.json')
+        for channels in channel_counts:
+            run_scenario = dict(scenario or {})
+            run_scenario['channels'] = channels
+            h5_file = os.path.join(tmp_dir, 'scan_%d.h5' % channels)
+            results.append((channels, run_one(configuration, run_scenario, h5_file,
+                                              cache_file, streaming)))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def report(results):
+    '''print the results as a table'''
+    print '%10s %6s %10s %10s %10s %12s %12s' % ('channels', 'PVs', 'connect,s', 'prelim,s',
+                                                 'post-scan,s', 'MB/s', 'file bytes')
+    for channels, t in results:
+        print '%10d %6d %10.4f %10.4f %10.4f %12.2f %12d' % (
+            channels, t['PVs'], t['connect'], t['prelim'], t['post-scan'],
+            t['throughput'], t['file bytes'])
+
+
+def get_CLI_options():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('xml_config_file',
+                    action='store',
+                    nargs='?',
+                    default=saveFlyData.XML_CONFIGURATION_FILE,
+                    help="XML configuration file, default: " + saveFlyData.XML_CONFIGURATION_FILE)
+
+    parser.add_argument('--channels',
+                    action='store',
+                    default=','.join(map(str, DEFAULT_CHANNELS)),
+                    help="comma-separated numbers of MCA channels, default: %(default)s")
+
+    parser.add_argument('--scenario',
+                    action='store',
+                    default=None,
+                    help="JSON scenario file for simEpics (see simEpics.py)")
+
+    parser.add_argument('--scan-time',
+                    action='store',
+                    type=float,
+                    default=0.5,
+                    help="length of each simulated fly scan, s, default: %(default)s")
+
+    parser.add_argument('--stream',
+                    action='store_true',
+                    default=False,
+                    help="write the arrays while the (simulated) scan runs")
+
+    return parser.parse_args()
+
+
+def main():
+    cli_options = get_CLI_options()
+    scenario = {}
+    if cli_options.scenario is not None:
+        scenario = simEpics.SimulatedBackend(cli_options.scenario).scenario
+    scenario['scan_time_s'] = cli_options.scan_time
+    channel_counts = [int(n) for n in cli_options.channels.split(',')]
+    report(benchmark(cli_options.xml_config_file, channel_counts, scenario, cli_options.stream))
+
+
+if __name__ == '__main__':
+    main()
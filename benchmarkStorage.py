@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+
+'''
+compare HDF5 file size and write time of fly scan arrays with different storage options
+
+The arrays are taken from an existing fly scan file (default: test.h5)
+and written again with each set of storage options.  Use ``--channels``
+to tile the arrays to the length of a full-size scan.
+'''
+
+
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy
+
+import saveFlyData
+
+
+TEST_FILE = 'test.h5'
+ARRAY_LABELS = 'mca1 mca2 mca3 AR_PulsePositions'.split()
+
+# each is written as the XML attributes would be given in saveFlyData.xml
+STORAGE_CHOICES = (
+    ('contiguous', {}),
+    ('chunked', dict(chunks='auto')),
+    ('gzip-1', dict(compression='gzip', compression_level='1')),
+    ('gzip-4', dict(compression='gzip', compression_level='4')),
+    ('gzip-4+shuffle', dict(compression='gzip', compression_level='4', shuffle='true')),
+    ('gzip-9+shuffle', dict(compression='gzip', compression_level='9', shuffle='true')),
+    ('lzf', dict(compression='lzf')),
+    ('lzf+shuffle', dict(compression='lzf', shuffle='true')),
+    ('gzip-4+shuffle+float32', dict(compression='gzip', compression_level='4', shuffle='true', dtype='float32')),
+)
+
+
+def read_arrays(source_file, labels, channels = None):
+    '''read the fly scan arrays, optionally tiled to a length of ``channels``'''
+    arrays = {}
+    with h5py.File(source_file, 'r') as f:
+        group = f['/entry/flyScan']
+        for label in labels:
+            if label not in group:
+                continue
+            value = numpy.array(group[label])
+            if channels is not None and 0 < len(value) < channels:
+                value = numpy.resize(value, channels)
+            arrays[label] = value
+    return arrays
+
+
+def benchmark(arrays, repeat = 3):
+    '''write the arrays with each choice of storage options, return [(name, bytes, seconds)]'''
+    results = []
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for name, attrib in STORAGE_CHOICES:
+            storage = saveFlyData.parse_storage_options(attrib)
+            h5_file = os.path.join(tmp_dir, name + '.h5')
+            best = None
+            for _ in range(repeat):
+                if os.path.exists(h5_file):
+                    os.remove(h5_file)
+                t0 = time.time()
+                with h5py.File(h5_file, 'w') as f:
+                    for label, value in sorted(arrays.items()):
+                        saveFlyData.makeStorageDataset(f, label, value, storage)
+                elapsed = time.time() - t0
+                best = elapsed if best is None else min(best, elapsed)
+            results.append((name, os.path.getsize(h5_file), best))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def report(results, arrays):
+    '''print the results as a table'''
+    n = sum([value.nbytes for value in arrays.values()])
+    print 'arrays: ' + ', '.join(['%s[%d]' % (k, len(v)) for k, v in sorted(arrays.items())])
+    print 'raw data: %d bytes' % n
+    print '%-24s %12s %8s %10s' % ('storage', 'file bytes', 'ratio', 'write, ms')
+    for name, size, elapsed in results:
+        print '%-24s %12d %8.3f %10.2f' % (name, size, float(size)/n, elapsed*1000)
+
+
+def get_CLI_options():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+
+    parser.add_argument('data_file',
+                    action='store',
+                    nargs='?',
+                    default=TEST_FILE,
+                    help="fly scan HDF5 file with the arrays, default: " + TEST_FILE)
+
+    parser.add_argument('--channels',
+                    action='store',
+                    type=int,
+                    default=None,
+                    help="tile each array to this length (such as 9idcLAX:3820:MaxChannels)")
+
+    parser.add_argument('--repeat',
+                    action='store',
+                    type=int,
+                    default=3,
+                    help="report the best of this many writes, default: 3")
+
+    return parser.parse_args()
+
+
+def main():
+    cli_options = get_CLI_options()
+    arrays = read_arrays(cli_options.data_file, ARRAY_LABELS, cli_options.channels)
+    if len(arrays) == 0:
+        raise RuntimeError, 'no fly scan arrays found in ' + cli_options.data_file
+    report(benchmark(arrays, cli_options.repeat), arrays)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,162 @@
 #!/usr/bin/env python
 
-import epics
-from lxml import etree
-
-
-XML_FILE = 'saveFlyData.xml'
-XSD_FILE = 'saveFlyData.xsd'
-
-schema_tree = etree.parse(XSD_FILE)
-schema = etree.XMLSchema(schema_tree)
-parser = etree.XMLParser(schema = schema)
-
-try:
-  config = etree.parse(XML_FILE, parser)
-  print XML_FILE, 'is valid against rules defined in', XSD_FILE
-except Exception, exc:
-  print XML_FILE, 'is not valid against rules defined in', XSD_FILE
-  raise exc
-
-epics.ca.DEFAULT_CONNECTION_TIMEOUT = 0.2
-
-print '\n'*2
-print 'check that all the defined PVs are actually available'
-print '\n'*2
-not_connected = []
-for i, pv_node in enumerate(config.xpath('//PV')):
-    pvname = pv_node.attrib['pvname'].strip()
-    as_string = pv_node.attrib.get('string', "false").lower() in ('t', 'true')
-    pv = epics.PV(pvname, verbose=False)    # control the output
-    if pv.wait_for_connection():
-        if as_string:
-            v = pv.get(as_string=True)
-        else:
-            v = pv.get()
-        print i, pvname, v
+'''
+check the saveFlyData.py configuration and that all its PVs are available
+
+All the channels are created together and there is one wait (one
+deadline) for the whole set, so an IOC that is down costs one timeout,
+not one per PV.  The report is grouped by IOC prefix (the PV name up to
+the first colon) and shows the connect latency of each PV.  Arrays
+bigger than EPICS_CA_MAX_ARRAY_BYTES (as set by saveFlyData.py) are
+flagged, as are length_limit attributes that do not name another PV.
+
+The exit code is the sum of these (0: all is well):
+
+====  =============================================================
+code  meaning
+====  =============================================================
+1     some PVs did not connect
+2     some arrays are bigger than EPICS_CA_MAX_ARRAY_BYTES
+4     some length_limit attributes do not name a PV of the configuration
+8     the configuration is not valid (nothing else is checked)
+====  =============================================================
+'''
+
+
+import os
+import sys
+
+import saveFlyData      # sets EPICS_CA_MAX_ARRAY_BYTES, before any CA activity
+import pvCache
+
+
+CONNECTION_TIMEOUT_S = 2.0      # for all the PVs together
+CA_MAX_ARRAY_BYTES_DEFAULT = 16384      # EPICS default
+EXIT_NOT_CONNECTED = 1
+EXIT_ARRAY_TOO_BIG = 2
+EXIT_BAD_LENGTH_LIMIT = 4
+EXIT_INVALID_CONFIGURATION = 8
+
+# bytes per element of each CA field type (PyEpics type names)
+ELEMENT_BYTES = dict(string=40, char=1, short=2, int=2, enum=2, long=4, float=4, double=8)
+
+
+def ioc_prefix(pvname):
+    '''IOC prefix of the PV name, such as "9idcLAX:"'''
+    return pvname.split(':', 1)[0] + ':'
+
+
+def array_bytes(pv):
+    '''bytes of the full array (all NELM elements) of a connected PyEpics PV'''
+    field_type = str(pv.type).split('_')[-1]       # such as ctrl_double
+    return (pv.nelm or 1) * ELEMENT_BYTES.get(field_type, 8)
+
+
+def bad_length_limits(configuration):
+    '''list of (PV_Specification, length_limit) where length_limit names no PV'''
+    return [(pv_spec, pv_spec.length_limit)
+            for path, pv_spec in sorted(configuration.pvs.items())
+            if pv_spec.length_limit is not None
+            and pv_spec.length_limit not in configuration.pvs]
+
+
+def check(configuration, timeout = CONNECTION_TIMEOUT_S):
+    '''print the report, return the exit code'''
+    max_array_bytes = int(os.environ.get('EPICS_CA_MAX_ARRAY_BYTES',
+                                         CA_MAX_ARRAY_BYTES_DEFAULT))
+    pvnames = sorted(configuration.pvs_by_pvname)
+    channels = pvCache.shared().connect(pvnames, timeout)
+
+    exit_code = 0
+    not_connected = []
+    too_big = []
+    groups = {}
+    for pvname in pvnames:
+        groups.setdefault(ioc_prefix(pvname), []).append(pvname)
+
+    print 'check that all the defined PVs are actually available'
+    print 'EPICS_CA_MAX_ARRAY_BYTES = %d' % max_array_bytes
+    for prefix in sorted(groups):
+        names = groups[prefix]
+        connected = [n for n in names if channels[n].connected]
+        latencies = [channels[n].connect_time for n in connected]
+        print
+        msg = '%s %d of %d connected' % (prefix, len(connected), len(names))
+        if len(latencies) > 0:
+            msg += ', slowest %.3f s' % max(latencies)
+        print msg
+        for pvname in names:
+            cpv = channels[pvname]
+            labels = ', '.join([pv_spec.label for pv_spec in configuration.pvs_by_pvname[pvname]])
+            if not cpv.connected:
+                print '  %-40s %-20s !!!!!!!!! Could not connect' % (pvname, labels)
+                not_connected.append(pvname)
+                continue
+            msg = '  %-40s %-20s %7.3f s' % (pvname, labels, cpv.connect_time)
+            nbytes = array_bytes(cpv.pv)
+            if (cpv.pv.nelm or 1) > 1:
+                msg += '  %d elements, %d bytes' % (cpv.pv.nelm, nbytes)
+                if nbytes > max_array_bytes:
+                    msg += '  !!!!!!!!! more than EPICS_CA_MAX_ARRAY_BYTES'
+                    too_big.append(pvname)
+            elif cpv.latest is not None:
+                as_string = configuration.pvs_by_pvname[pvname][0].as_string
+                if as_string:
+                    msg += '  ' + str(cpv.latest.char_value)
+                else:
+                    msg += '  ' + str(cpv.latest.value)
+            print msg
+
+    bad_limits = bad_length_limits(configuration)
+
+    print
+    if len(not_connected) > 0:
+        exit_code += EXIT_NOT_CONNECTED
+        print 'These PVs did not connect: \n* ' + '\n* '.join(not_connected)
     else:
-        print i, pvname, '!!!!!!!!! Could not connect'
-        not_connected.append(pvname)
-
-if len(not_connected) > 0:
-    print '\n'*3
-    print 'These PVs did not connect: \n*', '\n* '.join(not_connected)
-else:
-    print 'All PVs connected'
+        print 'All PVs connected'
+    if len(too_big) > 0:
+        exit_code += EXIT_ARRAY_TOO_BIG
+        print 'These arrays are bigger than EPICS_CA_MAX_ARRAY_BYTES: \n* ' + '\n* '.join(too_big)
+    if len(bad_limits) > 0:
+        exit_code += EXIT_BAD_LENGTH_LIMIT
+        print 'These length_limit attributes do not name a PV:'
+        for pv_spec, length_limit in bad_limits:
+            print '* %s: length_limit="%s"' % (pv_spec.hdf5_path, length_limit)
+    return exit_code
+
+
+def get_CLI_options():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('xml_config_file',
+                    action='store',
+                    nargs='?',
+                    default=saveFlyData.XML_CONFIGURATION_FILE,
+                    help="XML configuration file, default: " + saveFlyData.XML_CONFIGURATION_FILE)
+
+    parser.add_argument('--timeout',
+                    action='store',
+                    type=float,
+                    default=CONNECTION_TIMEOUT_S,
+                    help="connection timeout for all the PVs together, s, default: %(default)s")
+
+    return parser.parse_args()
+
+
+def main():
+    cli_options = get_CLI_options()
+    try:
+        configuration = saveFlyData.ScanConfiguration(cli_options.xml_config_file)
+    except Exception, exc:
+        print cli_options.xml_config_file, 'is not a valid configuration:', exc
+        return EXIT_INVALID_CONFIGURATION
+    print cli_options.xml_config_file, 'is valid against rules defined in', saveFlyData.XSD_SCHEMA_FILE
+    print
+    return check(configuration, cli_options.timeout)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
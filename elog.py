@@ -2,128 +2,365 @@
 
 '''
 write current instrument conditions to the elog
+
+The PVs of the snapshot are listed, by section, in a snapshot definition
+(XML, default: elog.xml in the same directory as this file).  Each
+snapshot is kept in an append-only store (one JSON line per snapshot).
+It may be rendered as the padded text table (which is posted to the
+elog), an HTML table, or JSON, at the time or later (without EPICS).
+
+In scheduler mode (--every and/or --trigger), the channels stay
+connected and a snapshot of the monitored values is added to a
+size-bounded history file (oldest snapshots dropped first) at a fixed
+cadence or when a trigger PV changes.  Replay it with --store.
+
+In diff mode (--diff), only the rows that changed since the last posted
+snapshot are posted.  A row changed if its user or dial value moved by
+more than its deadband (from the definition).  The same comparison
+answers, from the store alone, when a PV changed (--history).
 '''
 
 
 #import setup_PyEpics_uc2	# remove dependency until needed
-from epics import PV
-from epics import caget
-import time, os
-
-# Create global variables with lists of PVs for various groups of information
-
-#			PV name[0]		   PV name[1]			    Message[2]             Use?[3]
-undulator = 	[	('ID09ds:GapSet.VAL',       'ID09ds:Gap.VAL',	         'Undulator gap (mm)',	 	    'Y'),
-                        ('ID09ds:EnergySet.VAL',    'ID09ds:Energy.VAL',          'Undulator ds energy [keV]',      'Y'),
-                        ('ID09us:GapSet.VAL',       'ID09us:Gap.VAL',             'Undulator us gap (mm)',          'Y'),
-                    ('ID09us:EnergySet.VAL',    'ID09us:Energy.VAL',          'Undulator energy (keV)',         'Y')]
-
-HHL_Slits = 	[   	('9ida:wbsupX.VAL',     '9ida:wbsupXRBV.VAL',  	  'HHL-Upstr-X (mm)',      'Y'),
-                   ('9ida:wbsupY.VAL',     '9ida:wbsupYRBV.VAL',	  'HHL-Upstr-Y(mm)',      'Y'),
-                   ('9ida:wbsdnX.VAL',     '9ida:wbsdnXRBV.VAL',	  'HHL-Dwnst-X(mm)',      'Y'),
-                   ('9ida:wbsdnY.VAL',     '9ida:wbsdnYRBV.VAL',	  'HHL-Dwnst-Y(mm)',     'Y')]
-
-Monochromator = [	('9ida:BraggERdbkAO','9ida:BraggERdbkAO',  	  'Monochromator energy (keV)',      'Y'),
-                   ('9ida:m11.RBV',     '9ida:m11.DRBV',             '(m11) Bragg-Angle(degrees)',      'Y'),
-                  ('9ida:m12.RBV',     '9ida:m12.DRBV',             '(m12) Xtal-Gap(mm)',              'Y'),
-                   ('9ida:m16.RBV',     '9ida:m16.DRBV',  	          '(m16) 2st-Xtal-Chi(degrees)',    'Y'),
-                  ('9ida:m15.RBV',     '9ida:m15.DRBV', 	           '(m15) 2nd-Xtal-Theta2(degrees)',   'Y')]
-
-#ADC_Slits = 	[	('9ida:m25.RBV',     '9ida:m25.DRBV',           '(m25) UHV-Slit-top(mm)',          'Y'),
-#       			('9ida:m26.RBV',     '9ida:m26.DRBV',	          '(m26) UHV-Slit-Bot(mm)',          'Y'),
-#       			('9ida:m27.RBV',     '9ida:m27.DRBV', 	  '(m27) UHV-Slit-InB(mm)',          'Y'),
-#       			('9ida:m28.RBV',     '9ida:m28.DRBV',	          '(m28) UHV-Slit-OutB(mm)',         'Y')]
-
-#bpm_up =	[	('9ida:m21.RBV',     '9ida:m21.DRBV', 	  '(m21) Upstream-BPM-Foil(mm)',     'Y')]
-
-#bpm_down = 	[       ('9ida:m22.RBV',     '9ida:m22.DRBV', 	  '(m22) Downstream-BPM-Foil(mm)',   'Y')]
-
-USAXS_Slits = 	[	('9idcLAX:m58:c2:m5.RBV',     '9idcLAX:m58:c2:m5.DRBV',        'USAXS Slit vert center(mm)',          'Y'),
-                   ('9idcLAX:m58:c2:m6.RBV',     '9idcLAX:m58:c2:m6.DRBV',	       'USAXS Slit hor  center(mm)',          'Y'),
-                   ('9idcLAX:m58:c2:m7.RBV',     '9idcLAX:m58:c2:m7.DRBV', 	 'USAXS Slit vert aperture(mm)',        'Y'),
-                   ('9idcLAX:m58:c2:m8.RBV',     '9idcLAX:m58:c2:m8.DRBV',        'USAXS Slit hor  aperture(mm)',	'Y')]
-
-
-M_stage = 	[	('9idcLAX:xps:c0:m1.RBV',     '9idcLAX:xps:c0:m1.DRBV',        'USAXS MR (degrees)',                    'Y'),
-                   ('9idcLAX:m58:c0:m2.RBV',     '9idcLAX:m58:c0:m2.DRBV',	 	'USAXS mx (mm)',		          'Y'),
-                   ('9idcLAX:m58:c0:m3.RBV',     '9idcLAX:m58:c0:m3.DRBV', 	 'USAXS my (mm)',		          'Y'),
-                   ('9idcLAX:m58:c0:m4.RBV',     '9idcLAX:m58:c0:m4.DRBV',        'USAXS m1y(mm)',		       		  'Y'),
-            ('9idcLAX:USAXS:MRcenter',    '9idcLAX:USAXS:MRcenter',        'USAXS MR center',		          'Y')]
-
-MS_stage = 	[	('9idcLAX:xps:c0:m5.RBV',     '9idcLAX:xps:c0:m5.DRBV',        'USAXS MS stage angle(degrees)',         'Y'),
-                   ('9idcLAX:m58:c1:m1.RBV',     '9idcLAX:m58:c1:m1.DRBV',	 	'USAXS msx (mm)',		          'Y'),
-                   ('9idcLAX:m58:c1:m2.RBV',     '9idcLAX:m58:c1:m2.DRBV', 	 'USAXS msy (mm)',		          'Y'),
-                   ('9idcLAX:xps:c0:m3.RBV',     '9idcLAX:xps:c0:m3.DRBV',        'USAXS mst (deg)',		       	  'Y'),
-            ('9idcLAX:USAXS:MSRcenter',    '9idcLAX:USAXS:MSRcenter',        'USAXS MSR center',		          'Y')]
-
-
-AS_stage = 	[	('9idcLAX:xps:c0:m6.RBV',     '9idcLAX:xps:c0:m6.DRBV',        'USAXS AS stage angle(degrees)',         'Y'),
-                   ('9idcLAX:m58:c1:m3.RBV',     '9idcLAX:m58:c1:m3.DRBV',	 	'USAXS asx (mm)',		          'Y'),
-                   ('9idcLAX:m58:c1:m4.RBV',     '9idcLAX:m58:c1:m4.DRBV', 	 'USAXS asy (mm)',		          'Y'),
-                   ('9idcLAX:xps:c0:m4.RBV',     '9idcLAX:xps:c0:m4.DRBV',        'USAXS ast (deg)',		       	  'Y'),
-             ('9idcLAX:USAXS:ASRcenter',    '9idcLAX:USAXS:ASRcenter',      'USAXS ASR center',		          'Y')]
-
-A_stage = 	[	('9idcLAX:aero:c0:m1.RBV',     '9idcLAX:aero:c0:m1.DRBV',      'USAXS AR (degrees)',                    'Y'),
-                   ('9idcLAX:m58:c0:m5.RBV',     '9idcLAX:m58:c0:m5.DRBV',	 	'USAXS ax (mm)',		          'Y'),
-                   ('9idcLAX:m58:c0:m6.RBV',     '9idcLAX:m58:c0:m6.DRBV', 	 'USAXS ay (mm)',		          'Y'),
-                   ('9idcLAX:m58:c0:m7.RBV',     '9idcLAX:m58:c0:m7.DRBV',        'USAXS az (mm)',		       		  'Y'),
-            ('9idcLAX:USAXS:ARcenter',    '9idcLAX:USAXS:ARcenter',        'USAXS AR center',		          'Y')]
-
-User_Info = 	[	('9idcLAX:RunCycle',          '9idcLAX:RunCycle',              'Run cycle',                             'Y'),
-                   ('9idcLAX:UserName',          '9idcLAX:Username',    	         'User name',		                  'Y'),
-                   ('9idcLAX:GUPNumber',         '9idcLAX:GUPNumber', 	         'GUP number',		                  'Y')]
-
-Amplifiers = 	[	('9idcUSX:fem03:seq01:gain',  '9idcUSX:fem03:seq01:gain',      'I00 Gain',                              'Y'),
-                   ('9idcUSX:fem02:seq01:gain',  '9idcUSX:fem02:seq01:gain',      'I0 Gain',		                  'Y'),
-                   ('9idcLAX:m58:c1:m5.RBV',     '9idcLAX:m58:c1:m5.DRBV', 	 'I0 stage (mm)',	                  'Y')]
-
-SD_stages = 	[	('9idcLAX:m58:c2:m1.RBV',     '9idcLAX:m58:c2:m1.DRBV',        'USAXS sx (mm)',                         'Y'),
-                   ('9idcLAX:m58:c0:m2.RBV',     '9idcLAX:m58:c0:m2.DRBV',	 	'USAXS sy (mm)',		          'Y'),
-                   ('9idcLAX:m58:c0:m3.RBV',     '9idcLAX:m58:c0:m3.DRBV', 	 'USAXS dx (mm)',		          'Y'),
-                   ('9idcLAX:m58:c0:m4.RBV',     '9idcLAX:m58:c0:m4.DRBV',        'USAXS dy (mm)',		       		  'Y')]
-
-PinSAXS = 	[	('9idcLAX:mxv:c0:m1.RBV',     '9idcLAX:mxv:c0:m1.DRBV',        'USAXS pin_x (mm)',                      'Y'),
-                   ('9idcLAX:mxv:c0:m2.RBV',     '9idcLAX:mxv:c0:m2.DRBV', 	 'USAXS pin_z (mm)',		          'Y'),
-                   ('9idcLAX:mxv:c0:m8.RBV',     '9idcLAX:mxv:c0:m8.DRBV',        'USAXS pin_y (mm)',		       	  'Y')]
-
-USAXS_Params = 	[	('9idcLAX:USAXS:CountTime',   		'9idcLAX:USAXS:CountTime',    			'USAXS Count Time',           	'Y'),
-            ('9idcLAX:USAXS:NumPoints',   		'9idcLAX:USAXS:NumPoints',    			'USAXS Num Points',             'Y'),
-            ('9idcLAX:USAXS:Finish',    		'9idcLAX:USAXS:Finish',    			'USAXS Q max',                 	'Y'),
-            ('9idcLAX:USAXS:StartOffset',     	'9idcLAX:USAXS:StartOffset',    		'USAXS Start Offset',          	'Y'),
-            ('9idcLAX:USAXS:Sample_Y_Step',  	'9idcLAX:USAXS:Sample_Y_Step',    		'USAXS Sample Y Step',         	'Y'),
-            ('9idcLAX:USAXS_Pin:ax_in',	   	'9idcLAX:USAXS_Pin:ax_in',   			'USAXS ax in',                	'Y'),
-            ('9idcLAX:USAXS_Pin:Pin_y_out',	   	'9idcLAX:USAXS_Pin:Pin_y_out',   	    	'USAXS pin_y out',             	'Y'),
-            ('9idcLAX:USAXS_Pin:Pin_z_out',	   	'9idcLAX:USAXS_Pin:Pin_z_out',   		'USAXS pin_z out',             	'Y'),
-            ('9idcLAX:USAXS_Pin:USAXS_hslit_ap',   	'9idcLAX:USAXS_Pin:USAXS_hslit_ap',   		 'USAXS hor slit',               'Y'),
-                   ('9idcLAX:USAXS_Pin:USAXS_vslit_ap',   	'9idcLAX:USAXS_Pin:USAXS_hslit_ap',   		 'USAXS vert slit',              'Y'),
-                   ('9idcLAX:USAXS_Pin:USAXS_hgslit_ap',   '9idcLAX:USAXS_Pin:USAXS_hgslit_ap',  		 'USAXS Guard vert slit',      	'Y'),
-                   ('9idcLAX:USAXS_Pin:USAXS_vgslit_ap',   '9idcLAX:USAXS_Pin:USAXS_vgslit_ap',   		'USAXS Guard vert slit',      	'Y')]
-
-Pin_Params = 	[	('9idcLAX:WavelengthSpread',  	 	'9idcLAX:WavelengthSpread',    			'Wavelength Spread',           	'Y'),
-            ('9idcLAX:USAXS_Pin:BeamCenterX',	'9idcLAX:USAXS_Pin:BeamCenterX',    		'PinSAXS Beam Center X',        'Y'),
-            ('9idcLAX:USAXS_Pin:BeamCenterY',    	'9idcLAX:USAXS_Pin:BeamCenterY',    		'PinSAXS Beam Center Y',       	'Y'),
-            ('9idcLAX:USAXS_Pin:Distance',  	'9idcLAX:USAXS_Pin:Distance',    		'PinSAXS distance (mm)',      	'Y'),
-            ('9idcLAX:USAXS_Pin:PinPixSizeX',  	'9idcLAX:USAXS_Pin:PinPixSizeX',    		'PinSAXS pixels size X (mm)',  	'Y'),
-            ('9idcLAX:USAXS_Pin:PinPixSizeY',  	'9idcLAX:USAXS_Pin:PinPixSizeY',    		'PinSAXS pixels size Y (mm)',  	'Y'),
-            ('9idcLAX:USAXS_Pin:Exp_Al_Filter',  	'9idcLAX:USAXS_Pin:Exp_Al_Filter',    		'PinSAXS Exp Al Filter',  	'Y'),
-            ('9idcLAX:USAXS_Pin:Exp_Ti_Filter',  	'9idcLAX:USAXS_Pin:Exp_Ti_Filter',    		'PinSAXS Exp Ti Filter',  	'Y'),
-            ('9idcLAX:USAXS_Pin:directory',  	'9idcLAX:USAXS_Pin:directory',    		'PinSAXS Image bese directory', 'Y'),
-            ('9idcLAX:USAXS_Pin:ax_out',	   	'9idcLAX:USAXS_Pin:ax_out',   			'PinSAXS ax out',             	'Y'),
-            ('9idcLAX:USAXS_Pin:dx_out',	   	'9idcLAX:USAXS_Pin:dx_out',   			'PinSAXS dx out',             	'Y'),
-            ('9idcLAX:USAXS_Pin:Pin_y_in',	   	'9idcLAX:USAXS_Pin:Pin_y_in',   		'PinSAXS pin_y in',           	'Y'),
-            ('9idcLAX:USAXS_Pin:Pin_z_in',	   	'9idcLAX:USAXS_Pin:Pin_z_in',   		'PinSAXS pin_z in',             'Y'),
-            ('9idcLAX:USAXS_Pin:AcquireTime',   	'9idcLAX:USAXS_Pin:AcquireTime',   	 	'PinSAXS acquire time',         'Y'),
-            ('9idcLAX:USAXS_Pin:Pin_hslit_ap',   	'9idcLAX:USAXS_Pin:Pin_hslit_ap',   	 	'PinSAXS hor slit',             'Y'),
-                   ('9idcLAX:USAXS_Pin:Pin_vslit_ap',   	'9idcLAX:USAXS_Pin:Pin_hslit_ap',    		'PinSAXS vert slit',            'Y'),
-                   ('9idcLAX:USAXS_Pin:Pin_hgslit_ap',   	'9idcLAX:USAXS_Pin:Pin_hgslit_ap',    		'PinSAXS Guard vert slit',      'Y'),
-                   ('9idcLAX:USAXS_Pin:Pin_vgslit_ap',   	'9idcLAX:USAXS_Pin:Pin_vgslit_ap',    		'PinSAXS Guard vert slit',      'Y')]
-
+import collections
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+from lxml import etree
+
+import pvCache
+
+
+THIS_DIR = os.path.abspath(os.path.dirname(__file__))
+DEFINITION_FILE = os.path.join(THIS_DIR, 'elog.xml')
+ELOG_DATA_FILE = '/share1/Elog/ID_elog_data'
+SNAPSHOT_STORE_FILE = '/share1/Elog/elog_snapshots.jsonl'
+SNAPSHOT_HISTORY_FILE = '/share1/Elog/elog_history.jsonl'
+HISTORY_MAX_BYTES = 50 * 1024 * 1024
+HISTORY_EVICT_FRACTION = 0.75   # on eviction, keep the newest snapshots that fit in this fraction
+SCHEDULE_MIN_INTERVAL_S = 1.0   # triggered snapshots are no closer together than this
+ELOG_COMMAND = 'elog -h s9elog.xray.aps.anl.gov -d elog -p 80 -l "9ID Operations" -u "usaxs" "mu8rubo!" -a "Author=USAXS" -a "Category=USAXS_operations" -a "Type=Configuration" -a "Subject=Instrument/PV Snapshot" -f %s " "'
+#ELOG_COMMAND = 'elog -h 164.54.162.133 -p 8081 -l 15-ID-D -a Author=SYSTEM -a Type=Routine -a Subject="System snapshot" -f %s " "'
+SNAPSHOT_TIMEOUT_S = 2.0
+NOT_CONNECTED = 'not connected'
 
 size2 = 33
 
+# one row of the snapshot definition
+SnapshotPV = collections.namedtuple('SnapshotPV', 'section description pvname dial_pvname deadband')
+
+# one row of a snapshot, values are None if the PV did not answer
+Reading = collections.namedtuple('Reading',
+    'section description pvname value text dial_pvname dial_value dial_text timestamp')
+
 # end of global definitions
 
-# create some functions...
+
+def read_definition(xml_file = None):
+    '''list of SnapshotPV, in the order of the definition file'''
+    xml_file = xml_file or DEFINITION_FILE
+    root = etree.parse(xml_file).getroot()
+    if root.tag != 'elogSnapshot':
+        raise RuntimeError, 'not an elog snapshot definition: ' + xml_file
+    definition = []
+    for section in root.findall('section'):
+        for node in section.findall('PV'):
+            if node.get('use', 'true').lower() in ('f', 'false'):
+                continue
+            pvname = node.attrib['pvname'].strip()
+            definition.append(SnapshotPV(section.attrib['title'],
+                                         node.attrib['description'],
+                                         pvname,
+                                         node.get('dial', pvname).strip(),
+                                         float(node.get('deadband', 0))))
+    return definition
+
+
+def definition_deadbands(definition):
+    '''dictionary {pvname: deadband} of the definition'''
+    return dict([(row.pvname, row.deadband) for row in definition])
+
+
+def definition_pvnames(definition):
+    '''all the PV names used (user and dial) by the definition'''
+    names = set()
+    for row in definition:
+        names.update((row.pvname, row.dial_pvname))
+    return sorted(names)
+
+
+def take_snapshot(pvnames, timeout = SNAPSHOT_TIMEOUT_S):
+    '''
+    read all the PVs at once, return dictionary {pvname: (value, text, timestamp)}
+
+    The values come from the shared monitored PV cache (pvCache): all
+    the channels are created before any waiting, so all the searches and
+    the first (DBR_CTRL, with precision) monitor events arrive together.
+    There is one overall timeout for the whole set.  A PV that did not
+    answer in time is not in the dictionary.
+    '''
+    values = pvCache.get_many(pvnames, timeout)
+    return dict([(pvname, (_plain(v.value), v.char_value, v.timestamp))
+                 for pvname, v in values.items()])
+
+
+class SnapshotMonitor(object):
+    '''
+    keep monitored connections to all the PVs of a definition open
+
+    The channels are those of the shared monitored PV cache (pvCache),
+    so each snapshot only reads the latest monitored values (no channel
+    access traffic).  A change (beyond its deadband) of any trigger PV
+    since the last snapshot sets the ``changed`` event.
+    '''
+
+    def __init__(self, definition, triggers = (), timeout = SNAPSHOT_TIMEOUT_S):
+        self.definition = definition
+        self.pvnames = definition_pvnames(definition)
+        self.deadbands = definition_deadbands(definition)
+        self.triggers = set(triggers)
+        self.snapshot_values = {}   # {pvname: (value, text, timestamp)}, at the last snapshot
+        self.changed = threading.Event()
+        take_snapshot(self.pvnames, timeout)        # connect all, wait once
+        for pvname in self.triggers:
+            pvCache.subscribe(pvname, self._receive)
+
+    def _receive(self, pvname=None, value=None, **kw):
+        '''monitor callback of a trigger PV'''
+        old = self.snapshot_values.get(pvname, (None,))[0]
+        if value_changed(old, _plain(value), self.deadbands.get(pvname, 0)):
+            self.changed.set()
+
+    def snapshot(self):
+        '''new Snapshot from the monitored values'''
+        self.changed.clear()
+        self.snapshot_values = take_snapshot(self.pvnames, 0)
+        return Snapshot.from_values(self.definition, self.snapshot_values)
+
+    def close(self):
+        for pvname in self.triggers:
+            pvCache.shared().unsubscribe(pvname, self._receive)
+
+
+def _plain(value):
+    '''value as a plain Python (JSON) type'''
+    if hasattr(value, 'tolist'):
+        return value.tolist()       # numpy array or scalar
+    return value
+
+
+class Snapshot(object):
+    '''readings of all the rows of a snapshot definition at one time'''
+
+    def __init__(self, time_text, readings, posted = False, since = None):
+        self.time = time_text
+        self.readings = readings
+        self.posted = posted    # was this snapshot posted to the elog?
+        self.since = since      # time of the earlier snapshot, if this is a delta
+
+    @classmethod
+    def capture(cls, definition, timeout = SNAPSHOT_TIMEOUT_S):
+        '''take a new snapshot from EPICS'''
+        return cls.from_values(definition, take_snapshot(definition_pvnames(definition), timeout))
+
+    @classmethod
+    def from_values(cls, definition, values):
+        '''new snapshot, now, from dictionary {pvname: (value, text, timestamp)}'''
+        t = str(datetime.datetime.now()).split('.')[0]
+        missing = (None, None, None)
+        readings = []
+        for row in definition:
+            value, text, timestamp = values.get(row.pvname, missing)
+            dial_value, dial_text, _ts = values.get(row.dial_pvname, missing)
+            readings.append(Reading(row.section, row.description,
+                                    row.pvname, value, text,
+                                    row.dial_pvname, dial_value, dial_text,
+                                    timestamp))
+        return cls(t, readings)
+
+    def delta(self, previous, deadbands = {}):
+        '''new Snapshot with only the readings that changed since the previous snapshot'''
+        earlier = previous.by_pvname()
+        readings = []
+        for reading in self.readings:
+            old = earlier.get(reading.pvname)
+            if old is None or reading_changed(old, reading, deadbands.get(reading.pvname, 0)):
+                readings.append(reading)
+        return Snapshot(self.time, readings, since=previous.time)
+
+    def by_pvname(self):
+        '''dictionary {pvname: Reading}'''
+        return dict([(r.pvname, r) for r in self.readings])
+
+    def sections(self):
+        '''list of (title, [Reading, ...]) in the order of the definition'''
+        result = []
+        for reading in self.readings:
+            if len(result) == 0 or result[-1][0] != reading.section:
+                result.append((reading.section, []))
+            result[-1][1].append(reading)
+        return result
+
+    def to_json(self):
+        '''one compact line of JSON'''
+        return json.dumps(dict(time=self.time,
+                               posted=self.posted,
+                               fields=Reading._fields,
+                               readings=[list(r) for r in self.readings]),
+                          separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        d = json.loads(text)
+        fields = d.get('fields', Reading._fields)
+        readings = []
+        for row in d['readings']:
+            kw = dict(zip(fields, row))
+            readings.append(Reading(*[kw.get(name) for name in Reading._fields]))
+        return cls(d['time'], readings, posted=d.get('posted', False))
+
+
+class SnapshotStore(object):
+    '''
+    append-only file of snapshots, one JSON line each, oldest first
+
+    With max_bytes, the file is a ring buffer: when it grows beyond
+    max_bytes, the oldest snapshots are dropped (the file is replaced
+    by one with the newest snapshots that fit in HISTORY_EVICT_FRACTION
+    of max_bytes).
+    '''
+
+    def __init__(self, store_file = None, max_bytes = None):
+        self.store_file = store_file or SNAPSHOT_STORE_FILE
+        self.max_bytes = max_bytes
+
+    def append(self, snapshot):
+        with open(self.store_file, 'a') as fp:
+            fp.write(snapshot.to_json() + '\n')
+        if self.max_bytes is not None and os.path.getsize(self.store_file) > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        '''drop the oldest snapshots'''
+        with open(self.store_file, 'r') as fp:
+            lines = fp.readlines()
+        keep = len(lines) - 1       # the newest snapshot is always kept
+        size = len(lines[keep])
+        while keep > 0 and size + len(lines[keep-1]) <= self.max_bytes * HISTORY_EVICT_FRACTION:
+            keep -= 1
+            size += len(lines[keep])
+        tmp_file = self.store_file + '.tmp'
+        with open(tmp_file, 'w') as fp:
+            fp.writelines(lines[keep:])
+        os.rename(tmp_file, self.store_file)    # readers see the old or the new file, never part
+
+    def snapshots(self):
+        '''generate the stored snapshots, oldest first (unreadable lines are skipped)'''
+        if not os.path.exists(self.store_file):
+            return
+        with open(self.store_file, 'r') as fp:
+            for line in fp:
+                try:
+                    yield Snapshot.from_json(line)
+                except (ValueError, KeyError, TypeError):
+                    pass    # such as a line cut short
+
+    def get(self, index):
+        '''one stored snapshot, by position (negative counts back from the newest)'''
+        return list(self.snapshots())[index]
+
+    def last_posted(self):
+        '''the newest snapshot that was posted to the elog, None if there is none'''
+        last = None
+        for snapshot in self.snapshots():
+            if snapshot.posted:
+                last = snapshot
+        return last
+
+    def history(self, name, deadbands = {}):
+        '''
+        generate (time, previous Reading, Reading) each time a PV changed
+
+        The PV is given by its name or its description.  Consecutive
+        stored snapshots are compared, with the deadband of the PV.
+        '''
+        previous = None
+        for snapshot in self.snapshots():
+            for reading in snapshot.readings:
+                if name in (reading.pvname, reading.description):
+                    break
+            else:
+                continue
+            deadband = deadbands.get(reading.pvname, 0)
+            if previous is not None and reading_changed(previous, reading, deadband):
+                yield snapshot.time, previous, reading
+            previous = reading
+
+
+def run_scheduler(monitor, store, interval = None):
+    '''
+    add a snapshot to the store every interval (s) and when a trigger PV changes
+
+    Runs until interrupted (^C).  With no interval, only trigger PV
+    changes make snapshots.  Raises RuntimeError if there is neither an
+    interval nor a trigger PV (no snapshot would ever be taken).
+    '''
+    if interval is None and len(monitor.triggers) == 0:
+        raise RuntimeError, 'no interval and no trigger PV: no snapshot would be taken'
+    next_time = time.time()
+    while True:
+        timeout = 1e6       # Event.wait() with no timeout cannot be interrupted by ^C in Python 2
+        if interval is not None:
+            timeout = max(next_time - time.time(), 0)
+        triggered = monitor.changed.wait(timeout)
+        now = time.time()
+        due = interval is not None and now >= next_time
+        if triggered or due:
+            store.append(monitor.snapshot())
+            if due:
+                next_time = now + interval
+            time.sleep(SCHEDULE_MIN_INTERVAL_S)
+
+
+def trigger_pvnames(definition, names):
+    '''PV names of the definition rows named (by PV name or description) in names'''
+    return [row.pvname for row in definition
+            if row.pvname in names or row.description in names]
+
+
+def unknown_triggers(definition, names):
+    '''the names that match no PV name and no description of the definition'''
+    known = set([row.pvname for row in definition] + [row.description for row in definition])
+    return [name for name in names if name not in known]
+
+
+def value_changed(old, new, deadband = 0):
+    '''did the value change by more than the deadband (any change, if not a number)?'''
+    if old is None or new is None:
+        return old is not new       # connected or disconnected
+    try:
+        return abs(float(new) - float(old)) > deadband
+    except (TypeError, ValueError):
+        return new != old           # text or array
+
+
+def reading_changed(old, new, deadband = 0):
+    '''did the user or the dial value change by more than the deadband?'''
+    return value_changed(old.value, new.value, deadband) \
+        or value_changed(old.dial_value, new.dial_value, deadband)
+
+
+def _text(text, value):
+    if text is None and value is None:
+        return NOT_CONNECTED
+    if text is None:
+        text = value
+    if isinstance(text, basestring):
+        return text         # unicode, when read back from the store
+    return str(text)
 
 
 def createTitle():
@@ -132,50 +369,17 @@ def createTitle():
     space3 = 8
     title = 'Description (FOE)'+space2*' '+'User Value' + space3*' ' + 'Dial Value'
     # spaces = 15*" "
-    f.write(title + '\n')
-
-
-def writeLines(list):
-
-    #Create lines
-    def createLine(i):
-        """Returns entries format"""
-        getpv1 = PV(pvname=list[i][0])
-        time.sleep(.2)
-        getpv2 = PV(pvname=list[i][1])
-        time.sleep(.2)
-        s1 = getpv1.char_value
-        s2 = getpv2.char_value
-        space1 = size2 - len(list[i][2])+1
-        space2 = size2 - len(str(caget(list[i][0])))-10
-        line = list[i][2]+space1*' '+str(s1) + space2*' ' + str(s2)
-        return line
-
-    #Enter the entries
-    """
-    for i in range(len(list)):
-        if (i+1)%2 == 0:
-        line = createLine(i)
-            f.write(line + '\n')
-        else:
-        length = len(str(caget(list[i][1])))
-        number = 15 - length
-        spaces = " " * number
-        line = createLine(i)
-            f.write(line + spaces)
-    """
-    for i in range(len(list)):
-        line = createLine(i)
-        f.write(line + '\n')
-
-#Check whether even or odd
-def numCheck(list):
-    if len(list)%2 == 0:
-        writeLines(list)
-    else:
-        writeLines(list)
-        f.write('\n')
+    return title + '\n'
+
 
+def createLine(reading):
+    """Returns entries format"""
+    s1 = _text(reading.text, reading.value)
+    s2 = _text(reading.dial_text, reading.dial_value)
+    space1 = size2 - len(reading.description)+1
+    space2 = size2 - len(s1)-10
+    line = reading.description+space1*' '+s1 + space2*' ' + s2
+    return line
 
 
 #Create categories
@@ -183,55 +387,202 @@ def createCategory(title):
     NUMBER = 47 + 14
     halfnum = (NUMBER - len(title))/2
     dashes = halfnum * "-"
-    createLine = "\n" + dashes + ">" + title + "<" + dashes + "\n"
-    f.write(createLine)
-
+    return "\n" + dashes + ">" + title + "<" + dashes + "\n"
+
+
+def render_text(snapshot):
+    '''the padded text table (as posted to the elog)'''
+    #Write into respective columns
+    text = createTitle()
+    if snapshot.since is not None:
+        text += 'changed since %s\n' % snapshot.since
+    for title, readings in snapshot.sections():
+        text += createCategory(title)
+        for reading in readings:
+            text += createLine(reading) + '\n'
+        #Check whether even or odd
+        if len(readings)%2 != 0:
+            text += '\n'
+    return text
+
+
+def render_html(snapshot):
+    '''an HTML table, one section after another'''
+    def esc(text):
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    caption = 'instrument snapshot: ' + snapshot.time
+    if snapshot.since is not None:
+        caption += ', changed since ' + snapshot.since
+    html = ['<table border="1">',
+            '<caption>%s</caption>' % esc(caption),
+            '<tr><th>Description</th><th>User Value</th><th>Dial Value</th></tr>']
+    for title, readings in snapshot.sections():
+        html.append('<tr><th colspan="3">%s</th></tr>' % esc(title))
+        for r in readings:
+            html.append('<tr><td>%s</td><td>%s</td><td>%s</td></tr>' % (
+                esc(r.description),
+                esc(_text(r.text, r.value)),
+                esc(_text(r.dial_text, r.dial_value))))
+    html.append('</table>')
+    return '\n'.join(html) + '\n'
+
+
+def render_json(snapshot):
+    '''JSON, one object per reading'''
+    return json.dumps(dict(time=snapshot.time,
+                           since=snapshot.since,
+                           readings=[r._asdict() for r in snapshot.readings]),
+                      indent=2) + '\n'
+
+
+RENDERERS = dict(text=render_text, html=render_html, json=render_json)
 
 #  End of create functions...
 
-# write the log file....
-
-
-# and this now gets run when all above was setup....
-# Open file
-f=file('/share1/Elog/ID_elog_data','w+')
-
-#Write into respective columns
-createTitle()
-createCategory("User Information")
-numCheck(User_Info)
-createCategory("Undulator")
-numCheck(undulator)
-createCategory("HHL Slits")
-numCheck(HHL_Slits)
-createCategory("Monochromator")
-numCheck(Monochromator)
-#createCategory("ADC slits")
-#numCheck(ADC_Slits)
-createCategory("USAXS slits positons")
-numCheck(USAXS_Slits)
-createCategory("USAXS M stage")
-numCheck(M_stage)
-createCategory("USAXS MS stage")
-numCheck(MS_stage)
-createCategory("USAXS AS stage")
-numCheck(AS_stage)
-createCategory("USAXS A stage")
-numCheck(A_stage)
-createCategory("USAXS Sample and Detector stages")
-numCheck(SD_stages)
-createCategory("USAXS PinSAXS stage")
-numCheck(PinSAXS)
-createCategory("USAXS Aplifiers")
-numCheck(Amplifiers)
-createCategory("USAXS Parameters")
-numCheck(USAXS_Params)
-createCategory("PinSAXS parameters")
-numCheck(Pin_Params)
-f.close()
-
-#Run elog client to add to logbook. Have to add as an attachment. Table is messed up if it is sent as text.
-
-#os.system('elog -h 164.54.162.133 -p 8081 -l 15-ID-D -a Author=SYSTEM -a Type=Routine -a Subject="System snapshot" -f /share1/Elog/ID_elog_data " "')
-
-os.system('elog -h s9elog.xray.aps.anl.gov -d elog -p 80 -l "9ID Operations" -u "usaxs" "mu8rubo!" -a "Author=USAXS" -a "Category=USAXS_operations" -a "Type=Configuration" -a "Subject=Instrument/PV Snapshot" -f /share1/Elog/ID_elog_data " "')
+
+def get_CLI_options():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('--definition',
+                    action='store',
+                    default=DEFINITION_FILE,
+                    help="snapshot definition (XML), default: " + DEFINITION_FILE)
+
+    parser.add_argument('--store',
+                    action='store',
+                    default=SNAPSHOT_STORE_FILE,
+                    help="snapshot store (JSON lines), default: " + SNAPSHOT_STORE_FILE)
+
+    parser.add_argument('--format',
+                    action='store',
+                    choices=sorted(RENDERERS),
+                    default='text',
+                    help="how to render the snapshot, default: text")
+
+    parser.add_argument('--no-post',
+                    action='store_true',
+                    default=False,
+                    help="take and store the snapshot, print it instead of posting to the elog")
+
+    parser.add_argument('--every',
+                    action='store',
+                    type=float,
+                    default=None,
+                    help="scheduler mode: add a snapshot to the history file every EVERY seconds")
+
+    parser.add_argument('--trigger',
+                    action='append',
+                    default=[],
+                    help="scheduler mode: add a snapshot when this PV (name or description) changes (may be given more than once)")
+
+    parser.add_argument('--history-file',
+                    action='store',
+                    default=SNAPSHOT_HISTORY_FILE,
+                    help="scheduler mode: history file (JSON lines), default: " + SNAPSHOT_HISTORY_FILE)
+
+    parser.add_argument('--max-bytes',
+                    action='store',
+                    type=int,
+                    default=HISTORY_MAX_BYTES,
+                    help="scheduler mode: oldest snapshots are dropped beyond this size, default: %(default)s")
+
+    parser.add_argument('--diff',
+                    action='store_true',
+                    default=False,
+                    help="post only what changed (beyond the deadbands) since the last posted snapshot")
+
+    parser.add_argument('--history',
+                    action='store',
+                    default=None,
+                    help="list when a PV (name or description) changed, from the store, no EPICS")
+
+    parser.add_argument('--show',
+                    action='store',
+                    type=int,
+                    default=None,
+                    help="print a stored snapshot (0: oldest, -1: newest), no EPICS")
+
+    parser.add_argument('--list',
+                    action='store_true',
+                    default=False,
+                    help="list the times of the stored snapshots, no EPICS")
+
+    cli_options = parser.parse_args()
+    if cli_options.every is not None and cli_options.every <= 0:
+        parser.error('--every must be more than 0 seconds')
+    if len(cli_options.trigger) > 0:
+        unknown = unknown_triggers(read_definition(cli_options.definition), cli_options.trigger)
+        if len(unknown) > 0:
+            parser.error('--trigger matches no PV name or description of %s: %s'
+                         % (cli_options.definition, ', '.join(unknown)))
+    return cli_options
+
+
+def main():
+    cli_options = get_CLI_options()
+    store = SnapshotStore(cli_options.store)
+    render = RENDERERS[cli_options.format]
+
+    if cli_options.list:
+        for i, snapshot in enumerate(store.snapshots()):
+            print i, snapshot.time
+        return
+    if cli_options.show is not None:
+        sys.stdout.write(render(store.get(cli_options.show)))
+        return
+
+    definition = read_definition(cli_options.definition)
+    deadbands = definition_deadbands(definition)
+    if cli_options.history is not None:
+        for t, old, new in store.history(cli_options.history, deadbands):
+            print '%s  %s  %s -> %s  (dial: %s -> %s)' % (
+                t, new.description,
+                _text(old.text, old.value), _text(new.text, new.value),
+                _text(old.dial_text, old.dial_value), _text(new.dial_text, new.dial_value))
+        return
+
+    if cli_options.every is not None or len(cli_options.trigger) > 0:
+        triggers = trigger_pvnames(definition, cli_options.trigger)
+        monitor = SnapshotMonitor(definition, triggers)
+        try:
+            run_scheduler(monitor,
+                          SnapshotStore(cli_options.history_file, cli_options.max_bytes),
+                          cli_options.every)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            monitor.close()
+        return
+
+    snapshot = Snapshot.capture(definition)
+    report = snapshot
+    if cli_options.diff:
+        previous = store.last_posted()
+        if previous is not None:
+            report = snapshot.delta(previous, deadbands)
+    if cli_options.no_post:
+        store.append(snapshot)
+        sys.stdout.write(render(report))
+        return
+    if len(report.readings) == 0:
+        store.append(snapshot)
+        print 'no changes since', report.since
+        return
+
+    # write the log file....
+    f = open(ELOG_DATA_FILE, 'w+')
+    try:
+        f.write(render(report))
+    finally:
+        f.close()
+
+    #Run elog client to add to logbook. Have to add as an attachment. Table is messed up if it is sent as text.
+    snapshot.posted = os.system(ELOG_COMMAND % ELOG_DATA_FILE) == 0
+    store.append(snapshot)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+'''
+one monitored EPICS channel per PV name, shared by all the tools in this process
+
+The latest value, text, timestamp, and alarm severity of each PV come
+from its monitor, so repeated reads are served from memory and never
+go back to the network.  A disconnected PV has no value (None, or
+missing from get_many()) until it connects again::
+
+  import pvCache
+  print pvCache.get('9ida:BraggERdbkAO')
+  values = pvCache.get_many(['9idcLAX:USAXS:SAD.VAL', '9idcLAX:USAXS:SDD.VAL'], timeout=2)
+  pvCache.subscribe('9idcLAX:aero:c0:m1.HLM', callback)
+  pvCache.subscribe_connection('9idcLAX:aero:c0:m1.HLM', connection_callback)
+  print pvCache.shared().statistics()
+
+``get_many()`` creates all the channels it needs before it waits, then
+waits once (one deadline) for the whole set.  Arrays bigger than the
+PyEpics auto-monitor limit are not monitored; read those with epics.PV.
+'''
+
+
+import collections
+import threading
+import time
+
+import epics
+
+
+CONNECTION_TIMEOUT_S = 2.0
+POLL_INTERVAL_S = 0.01
+
+# latest monitored state of one PV
+Value = collections.namedtuple('Value', 'value char_value timestamp severity')
+
+
+class CachedPV(object):
+    '''one monitored channel, keeps the latest value and the connection statistics'''
+
+    def __init__(self, pvname, form = 'ctrl'):
+        self.pvname = pvname
+        self.latest = None          # Value, None until the first monitor event
+        self.created = time.time()
+        self.connect_time = None    # seconds from creation to first connection
+        self.connected = False
+        self.disconnects = 0
+        self.updates = 0
+        self.callbacks = []
+        self.connection_callbacks = []
+        self.first_value = threading.Event()
+        self.pv = epics.PV(pvname, form=form,
+                           callback=self._receive,
+                           connection_callback=self._connection)
+
+    def _receive(self, pvname=None, value=None, char_value=None,
+                 timestamp=None, severity=None, **kw):
+        self.latest = Value(value, char_value, timestamp, severity)
+        self.updates += 1
+        self.first_value.set()
+        for callback in list(self.callbacks):
+            callback(pvname=pvname, value=value, char_value=char_value,
+                     timestamp=timestamp, severity=severity, **kw)
+
+    def _connection(self, pvname=None, conn=None, **kw):
+        self.connected = bool(conn)
+        if conn and self.connect_time is None:
+            self.connect_time = time.time() - self.created
+        elif not conn:
+            # the last value is not live any more, the monitor sends a new one on reconnect
+            self.latest = None
+            self.first_value.clear()
+            self.disconnects += 1
+        for callback in list(self.connection_callbacks):
+            callback(pvname=pvname, conn=conn, **kw)
+
+    def wait(self, timeout):
+        '''wait for a (live) value, return it (None if there is none)'''
+        self.first_value.wait(timeout)
+        return self.latest
+
+    def close(self):
+        self.callbacks = []
+        self.connection_callbacks = []
+        self.pv.clear_callbacks()
+        self.pv.disconnect()
+
+
+class PVCache(object):
+    '''the cached channels, key: PV name'''
+
+    def __init__(self, form = 'ctrl'):
+        self.form = form
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def channel(self, pvname):
+        '''the CachedPV of this name, created (and monitored) on first use'''
+        with self.lock:
+            cpv = self.channels.get(pvname)
+            if cpv is None:
+                cpv = CachedPV(pvname, self.form)
+                self.channels[pvname] = cpv
+        return cpv
+
+    def get(self, pvname, as_string = False, timeout = CONNECTION_TIMEOUT_S):
+        '''latest value (or text) of one PV, None if no value arrived in time'''
+        latest = self.channel(pvname).wait(timeout)
+        if latest is None:
+            return None
+        if as_string:
+            return latest.char_value
+        return latest.value
+
+    def get_many(self, pvnames, timeout = CONNECTION_TIMEOUT_S):
+        '''
+        latest Value of many PVs, dictionary {pvname: Value}
+
+        All the channels are created first, then there is one wait for
+        the whole set.  PVs with no value by then are not in the result.
+        With timeout=0, only what is already in memory is returned.
+        '''
+        channels = [self.channel(pvname) for pvname in pvnames]
+        t_end = time.time() + timeout
+        while time.time() < t_end:
+            if len([c for c in channels if c.latest is None]) == 0:
+                break
+            time.sleep(POLL_INTERVAL_S)
+        return dict([(c.pvname, c.latest) for c in channels if c.latest is not None])
+
+    def connect(self, pvnames, timeout = CONNECTION_TIMEOUT_S):
+        '''
+        connect many PVs, dictionary {pvname: CachedPV}
+
+        As get_many(), with one wait for the whole set, but for the
+        connections (not the first values: arrays too big for the
+        PyEpics auto-monitor never get one).
+        '''
+        channels = dict([(pvname, self.channel(pvname)) for pvname in pvnames])
+        t_end = time.time() + timeout
+        while time.time() < t_end:
+            if len([c for c in channels.values() if not c.connected]) == 0:
+                break
+            time.sleep(POLL_INTERVAL_S)
+        return channels
+
+    def subscribe(self, pvname, callback):
+        '''call callback (PyEpics keywords) on every monitor event of this PV'''
+        self.channel(pvname).callbacks.append(callback)
+
+    def unsubscribe(self, pvname, callback):
+        cpv = self.channels.get(pvname)
+        if cpv is not None and callback in cpv.callbacks:
+            cpv.callbacks.remove(callback)
+
+    def subscribe_connection(self, pvname, callback):
+        '''call callback (keywords pvname, conn) when this PV connects or disconnects'''
+        self.channel(pvname).connection_callbacks.append(callback)
+
+    def unsubscribe_connection(self, pvname, callback):
+        cpv = self.channels.get(pvname)
+        if cpv is not None and callback in cpv.connection_callbacks:
+            cpv.connection_callbacks.remove(callback)
+
+    def statistics(self):
+        '''connection statistics of all the cached channels'''
+        channels = self.channels.values()
+        times = [c.connect_time for c in channels if c.connect_time is not None]
+        stats = dict(
+            channels = len(channels),
+            connected = len([c for c in channels if c.connected]),
+            never_connected = sorted([c.pvname for c in channels if c.connect_time is None]),
+            disconnects = sum([c.disconnects for c in channels]),
+            updates = sum([c.updates for c in channels]),
+        )
+        if len(times) > 0:
+            stats['connect_time_min_s'] = min(times)
+            stats['connect_time_mean_s'] = sum(times) / len(times)
+            stats['connect_time_max_s'] = max(times)
+        return stats
+
+    def close(self):
+        '''disconnect all the channels'''
+        with self.lock:
+            for cpv in self.channels.values():
+                cpv.close()
+            self.channels = {}
+
+
+_shared_cache = PVCache()       # no channels (no EPICS activity) until first used
+
+
+def shared():
+    '''the PVCache shared by all the tools in this process'''
+    return _shared_cache
+
+
+def get(pvname, as_string = False, timeout = CONNECTION_TIMEOUT_S):
+    '''latest value of a PV from the shared cache'''
+    return shared().get(pvname, as_string, timeout)
+
+
+def get_many(pvnames, timeout = CONNECTION_TIMEOUT_S):
+    '''latest Value of many PVs from the shared cache, dictionary {pvname: Value}'''
+    return shared().get_many(pvnames, timeout)
+
+
+def subscribe(pvname, callback):
+    '''call callback on every monitor event of this PV (shared cache)'''
+    shared().subscribe(pvname, callback)
+
+
+def subscribe_connection(pvname, callback):
+    '''call callback when this PV connects or disconnects (shared cache)'''
+    shared().subscribe_connection(pvname, callback)
+
+
+def main():
+    import sys
+    values = get_many(sys.argv[1:])
+    for pvname in sys.argv[1:]:
+        latest = values.get(pvname)
+        if latest is None:
+            print pvname, 'not connected'
+        else:
+            print pvname, latest.char_value
+    print shared().statistics()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+'''
+USAXS geometry: AR, AY, and DY motor positions for an array of Q values
+
+No GUI and no EPICS here: the user parameters are given as a
+snapshot (GeometryParameters), so whole scan tables may be computed
+from scripts::
+
+  import geometry
+  params = geometry.GeometryParameters(ar0=8.8, sad=120, sdd=560, ay0=0, dy0=0, energy=18)
+  ar, ay, dy = geometry.positions([1e-4, 1e-3, 1e-2], params)
+'''
+
+
+import collections
+import math
+import numpy
+
+
+A_keV = 12.3984244 # Angstrom * keV
+
+
+class GeometryParameters(collections.namedtuple('GeometryParameters',
+                                                'ar0 sad sdd ay0 dy0 energy')):
+    '''
+    snapshot of the user parameters for the Q to motor position calculation
+
+    :ar0 float: AR encoder at the center (Q=0), degrees
+    :sad float: sample to analyzer distance, mm
+    :sdd float: sample to detector distance, mm
+    :ay0 float: AY at Q=0, mm
+    :dy0 float: DY at Q=0, mm
+    :energy float: X-ray energy, keV
+    '''
+
+    @property
+    def lambda_over_4pi(self):
+        return A_keV / (self.energy * 4 * math.pi)
+
+
+def positions(Q, params):
+    '''
+    AR, AY, and DY (each a numpy array) for the Q values (1/A)
+
+    AR is NaN for any Q beyond reach at this energy.
+    '''
+    x = -numpy.asarray(Q, dtype=float) * params.lambda_over_4pi
+    with numpy.errstate(invalid='ignore'):
+        ar = params.ar0 + 2*numpy.degrees(numpy.arcsin(x))
+    dy = params.dy0 + params.sdd * numpy.tan(x)
+    ay = params.ay0 + params.sad * numpy.tan(x)
+    return ar, ay, dy
+
+
+def get_CLI_options():
+    import argparse
+    parser = argparse.ArgumentParser(description='AR, AY, and DY for each Q (1/A)')
+    parser.add_argument('Q', type=float, nargs='+', help='Q values, 1/A')
+    parser.add_argument('--energy', type=float, required=True, help='X-ray energy, keV')
+    parser.add_argument('--ar0', type=float, required=True, help='AR encoder at Q=0, degrees')
+    parser.add_argument('--sad', type=float, required=True, help='sample to analyzer distance, mm')
+    parser.add_argument('--sdd', type=float, required=True, help='sample to detector distance, mm')
+    parser.add_argument('--ay0', type=float, default=0.0, help='AY at Q=0, mm')
+    parser.add_argument('--dy0', type=float, default=0.0, help='DY at Q=0, mm')
+    return parser.parse_args()
+
+
+def main():
+    cli_options = get_CLI_options()
+    params = GeometryParameters(cli_options.ar0, cli_options.sad, cli_options.sdd,
+                                cli_options.ay0, cli_options.dy0, cli_options.energy)
+    ar, ay, dy = positions(cli_options.Q, params)
+    print '%14s %14s %12s %12s' % ('Q, 1/A', 'AR, degrees', 'AY, mm', 'DY, mm')
+    for row in zip(cli_options.Q, ar, ay, dy):
+        print '%14g %14.6f %12.3f %12.3f' % row
+
+
+if __name__ == '__main__':
+    main()
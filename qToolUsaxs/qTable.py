@@ -5,7 +5,7 @@ table of Q values and computed  motor positions
 
 from PyQt4 import QtCore, QtGui
 import datetime
-import bcdaqwidgets
+import math
 
 
 LABEL_COLUMN    = 0
@@ -16,6 +16,7 @@ DY_COLUMN       = 4
 DEFAULT_NUMBER_ROWS = 30
 
 BUTTON_CLUT = {False: 'yellow', True: 'lightgreen'}
+BUTTON_NO_VALUE_COLOR = '#eee'
 
 
 # TODO: table width (and column widths) should change when window size changes
@@ -29,7 +30,7 @@ class TableModel(QtCore.QAbstractTableModel):
     
     :datain [[label,Q]]: the data model, list of list(label,Q) values, if None, a default model is created
     :parent obj: groupBox that contains this model and related view
-    :recalc obj: method that computes AR, AY, & DY from Q and user parameters
+    :recalc obj: method that computes AR, AY, & DY arrays from an array of Q and user parameters
     """
     
     def __init__(self, datain, parent=None, recalc=None, *args):
@@ -114,23 +115,54 @@ class TableModel(QtCore.QAbstractTableModel):
         self.motors = motors
 
     def calc_row(self, row):
-        if self.recalc is not None:
-            Q = self.model[row][Q_COLUMN]
-            result = self.recalc(Q)
-            if result is not None:
-                ar, ay, dy = result
-                index_ar = self.index(row, AR_COLUMN)
-                index_ay = self.index(row, AY_COLUMN)
-                index_dy = self.index(row, DY_COLUMN)
-
-                self.setData(index_ar, ar, QtCore.Qt.EditRole)
-                self.setData(index_ay, ay, QtCore.Qt.EditRole)
-                self.setData(index_dy, dy, QtCore.Qt.EditRole)
+        self.calc_rows([row])
 
     def calc_all(self):
-        for row, model in enumerate(self.model):
-            if len(model[Q_COLUMN]) > 0:
-                self.calc_row(row)
+        self.calc_rows(range(len(self.model)))
+
+    def calc_rows(self, rows):
+        '''
+        recompute AR, AY, & DY of these rows in one call (rows without a Q are skipped)
+
+        ``dataChanged`` is emitted only for the rows with a new value.
+        '''
+        if self.recalc is None:
+            return
+        rows_Q, Q = [], []
+        for row in rows:
+            try:
+                Q.append(float(self.model[row][Q_COLUMN]))
+                rows_Q.append(row)
+            except (TypeError, ValueError):
+                pass        # such as empty text
+        if len(rows_Q) == 0:
+            return
+        result = self.recalc(Q)
+        if result is not None:
+            for row, ar, ay, dy in zip(rows_Q, *result):
+                changed = False
+                for column, value in ((AR_COLUMN, ar), (AY_COLUMN, ay), (DY_COLUMN, dy)):
+                    if _differs(self.model[row][column], value):
+                        self.setData(self.index(row, column), float(value), QtCore.Qt.EditRole)
+                        changed = True
+                if changed:
+                    self.dataChanged.emit(self.index(row, AR_COLUMN), self.index(row, DY_COLUMN))
+
+
+def _differs(old, new):
+    '''True if the new value is not the same number as the old (NaN is the same as NaN)'''
+    try:
+        old = float(old)
+    except (TypeError, ValueError):
+        return True
+    if math.isnan(old) and math.isnan(new):
+        return False
+    return old != new
+
+
+def _is_finite(value):
+    '''False for NaN and infinity'''
+    return not (math.isnan(value) or math.isinf(value))
 
 
 class TableView(QtGui.QTableView):
@@ -164,24 +196,24 @@ class TableView(QtGui.QTableView):
         self.resizeColumnsToContents()
         self.resizeRowsToContents()
 
-    def _buttonClicked(self, buttonname='', *args, **kw):
+    def _buttonClicked(self, buttonname, text):
         gb = self.parent()
         w = gb.parent()
         mw = w.parent()
         statusbar = mw.statusBar()
-        msg = buttonname + ' button: ' + self.sender().text()
+        msg = buttonname + ' button: ' + text
         statusbar.showMessage(msg)
         if self.doMove is not None:
-            self.doMove(buttonname, self.sender().text())
+            self.doMove(buttonname, QtCore.QString(text))
 
-    def AR_ButtonClicked(self):
-        self._buttonClicked('AR')
+    def AR_ButtonClicked(self, text):
+        self._buttonClicked('AR', text)
  
-    def AY_ButtonClicked(self):
-        self._buttonClicked('AY')
+    def AY_ButtonClicked(self, text):
+        self._buttonClicked('AY', text)
  
-    def DY_ButtonClicked(self):
-        self._buttonClicked('DY')
+    def DY_ButtonClicked(self, text):
+        self._buttonClicked('DY', text)
 
 
 class FloatControl(QtGui.QStyledItemDelegate):
@@ -198,39 +230,107 @@ class FloatControl(QtGui.QStyledItemDelegate):
 
 
 class ButtonControl(QtGui.QItemDelegate):
-    '''A QPushButton in every cell of the column to which it's applied'''
+    '''
+    Every cell of the column to which it's applied is painted as a push button
+
+    No widgets are created.  A click (press and release of the left mouse
+    button in the same cell) calls ``action(text)`` with the text of the cell.
+    A cell with no finite value (such as NaN, for a Q out of reach) is
+    painted as a disabled button with no text and ignores clicks.
+    Whether the value is within the motor's limits is cached per row.
+    When the motor's limits change, the whole column is asked again in
+    one (vectorized) call; a row is asked again alone when its value changes.
+    '''
     def __init__(self, parent, action, display_format='%f'):
         QtGui.QItemDelegate.__init__(self, parent)
         self.action = action
         self.format = display_format
         self.motor = None
+        self.pressed = None         # (row, column) of the cell pressed with the mouse
+        self.limits_cache = {}      # key: row, value: (value, in limits)
+        self.limits_version = None  # motor.limits_version of the cache
  
     def setMotor(self, motor):
         '''cache the motor mnemonic for use in coloring the button'''
         self.motor = motor
+        self.limits_cache = {}
+        self.limits_version = None
+
+    def inLimits(self, index, value):
+        '''is value within the motor's limits? (None if there is no motor)'''
+        if self.motor is None:
+            return None
+        if self.limits_version != self.motor.limits_version:
+            self._refresh_limits(index.model(), index.column())
+        cached = self.limits_cache.get(index.row())
+        if cached is None or cached[0] != value:
+            cached = (value, self.motor.inLimits(value))
+            self.limits_cache[index.row()] = cached
+        return cached[1]
+
+    def _refresh_limits(self, model, column):
+        '''ask the motor about every row of the column in one call'''
+        self.limits_version = self.motor.limits_version
+        values = []
+        for row in model.model:
+            try:
+                values.append(float(row[column]))
+            except (TypeError, ValueError):
+                values.append(float('nan'))     # never within limits
+        in_limits = self.motor.inLimits(values)
+        self.limits_cache = dict([(row, (value, bool(ok)))
+                                  for row, (value, ok) in enumerate(zip(values, in_limits))])
  
     def paint(self, painter, option, index):
-        widget = self.parent().indexWidget(index)
-        if widget is None:
-            # create the PushButton widget
-            value, ok = index.data().toDouble()     # *MUST* be a double
-            if ok:
-                text = self.format % value
-                owner = self.parent()
-                pb = QtGui.QPushButton(text, owner, clicked=self.action)
-                owner.setIndexWidget(index, pb)
+        value, ok = index.data().toDouble()     # *MUST* be a double
+        button = QtGui.QStyleOptionButton()
+        button.rect = option.rect.adjusted(1, 1, -1, -1)
+        if ok and not _is_finite(value):
+            button.state = QtGui.QStyle.State_None      # disabled, nothing to move to
+        else:
+            button.state = QtGui.QStyle.State_Enabled
+        if self.pressed == (index.row(), index.column()):
+            button.state |= QtGui.QStyle.State_Sunken
+        else:
+            button.state |= QtGui.QStyle.State_Raised
+        color = BUTTON_NO_VALUE_COLOR
+        if ok and not _is_finite(value):
+            button.text = ''
+        elif ok:
+            button.text = self.format % value
+            in_limits = self.inLimits(index, value)
+            if in_limits is not None:
+                color = BUTTON_CLUT[in_limits]
         else:
-            if isinstance(widget, QtGui.QPushButton):
-                # update the PushButton text if the model's value changed
+            button.text = index.data().toString()
+        button.palette = QtGui.QPalette(option.palette)
+        button.palette.setColor(QtGui.QPalette.Button, QtGui.QColor(color))
+
+        painter.save()
+        painter.fillRect(button.rect, QtGui.QColor(color))     # styles that ignore the palette
+        QtGui.QApplication.style().drawControl(QtGui.QStyle.CE_PushButton, button, painter)
+        painter.restore()
+
+    def editorEvent(self, event, model, option, index):
+        '''mouse press and release in the same cell is a click, there is no editor'''
+        cell = (index.row(), index.column())
+        kind = event.type()
+        if kind == QtCore.QEvent.MouseButtonPress and event.button() == QtCore.Qt.LeftButton:
+            value, ok = index.data().toDouble()
+            if ok and not _is_finite(value):
+                return True     # disabled button
+            self.pressed = cell
+            self.parent().viewport().update(option.rect)
+            return True
+        if kind == QtCore.QEvent.MouseButtonRelease and self.pressed is not None:
+            clicked = self.pressed == cell and option.rect.contains(event.pos())
+            self.pressed = None
+            self.parent().viewport().update(option.rect)
+            if clicked:
                 value, ok = index.data().toDouble()
-                sty = bcdaqwidgets.StyleSheet(widget)
-                if ok:
-                    text = self.format % value
-                    if text != widget.text():
-                        # update only if non-trivial
-                        widget.setText(text)
-                    if self.motor is not None:
-                        color = BUTTON_CLUT[self.motor.inLimits(value)]
-                        sty.updateStyleSheet({'background-color': color})
-                else:
-                    sty.updateStyleSheet({'background-color': '#eee'})
+                if ok and _is_finite(value):
+                    self.action(self.format % value)
+            return True
+        if kind == QtCore.QEvent.MouseButtonDblClick:
+            return True
+        return False
@@ -9,17 +9,23 @@ to move each of the motors.
 
 
 import epics
-import math
+import numpy
 import os
 import sys
+import time
 from PyQt4 import QtCore, QtGui, uic
 pyqtSignal = QtCore.pyqtSignal
 
 import bcdaqwidgets
 
 import config
+import geometry
 import qTable
 
+THIS_DIR = os.path.abspath(os.path.dirname(__file__))
+sys.path.append(os.path.dirname(THIS_DIR))     # USAXS_tools, for pvCache
+import pvCache
+
 __project_name__  = 'qToolUsaxs'
 __version__       = '2014-12'
 __author__        = 'Pete Jemian'
@@ -29,7 +35,6 @@ __copyright__     = 'Copyright (C) 2009-2014, UChicago Argonne, LLC, All Rights
 __license__       = 'qToolUsaxs is part of USAXS_tools; See LICENSE (included with this file) for full details.'
 __url__           = 'http://usaxs.xray.aps.anl.gov/livedata'
 
-THIS_DIR = os.path.abspath(os.path.dirname(__file__))
 MAIN_UI_FILE = os.path.join(THIS_DIR, 'qToolUsaxs.ui')
 ABOUT_UI_FILE = os.path.join(THIS_DIR, 'about.ui')
 LOGO_FILE = os.path.join(THIS_DIR, 'epicslogo101.gif')
@@ -63,23 +68,63 @@ PV_MAP = {
     'motor,DY'      : '9idcLAX:aero:c2:m1'
 }
 MOTOR_SYMBOLS = ('ar', 'ay', 'dy')
-CALC_ALL_DELAY_MS = 250
+LIMIT_FIELDS = ('HLM', 'LLM', 'DIR', 'OFF')
+CALC_ALL_DELAY_MS = 250     # default: at most one table recalculation in this interval
 
 
 class Motor(object):
+    '''
+    EPICS motor, with its soft limits kept from monitors
+
+    The .HLM, .LLM, .DIR, and .OFF fields are monitored (shared
+    monitored PV cache, pvCache).  Any update, and any connection or
+    disconnection of these fields (the IOC may come back with other limits),
+    drops the cached limits, increments ``limits_version``, and calls
+    ``limits_callback`` (from the PyEpics thread) if one is given.
+    '''
 
     pv = None
     pvname = None
     w_RBV = None
     w_VAL = None
+    limits_version = 0      # changes when the limits might have changed
+    limits_callback = None
+
+    def __init__(self):
+        self.limit_pvs = {}     # {field: pvname}
+        self.limits = None      # (low, high), None until (re)read from the monitors
 
     def connect(self, pvname):
         '''connect with EPICS'''
         if pvname is not None:
             self.pvname = pvname
             self.pv = epics.Motor(pvname)
+            for field in LIMIT_FIELDS:
+                self.limit_pvs[field] = pvname + '.' + field
+                pvCache.subscribe(self.limit_pvs[field], self._limits_changed)
+                pvCache.subscribe_connection(self.limit_pvs[field], self._limits_changed)
+            self._limits_changed()
+
+    def _limits_changed(self, *args, **kw):
+        '''monitor or connection callback: limits (or what they depend on) changed'''
+        self.limits = None
+        self.limits_version += 1
+        if self.limits_callback is not None:
+            self.limits_callback()
+
+    def getLimits(self):
+        '''(low, high) soft limits in user coordinates, None if not known'''
+        if self.limits is None and len(self.limit_pvs) > 0:
+            low = pvCache.get(self.limit_pvs['LLM'], timeout=0)
+            high = pvCache.get(self.limit_pvs['HLM'], timeout=0)
+            if low is not None and high is not None:
+                self.limits = (low, high)
+        return self.limits
 
     def move(self, value):
+        '''move to value, raise ValueError if it is not a finite number'''
+        if not numpy.isfinite(value):
+            raise ValueError, 'cannot move %s to %s' % (self.pvname, value)
         if self.pv is not None:
             self.pv.move(value)
 
@@ -88,7 +133,17 @@ class Motor(object):
             self.pv.stop()
 
     def inLimits(self, value):
-        return self.pv is not None and self.pv.within_limits(value)
+        '''is value within the soft limits? (a number or an array, the result is the same)'''
+        limits = self.getLimits()
+        v = numpy.asarray(value, dtype=float)
+        if limits is None:
+            result = numpy.zeros(v.shape, dtype=bool)
+        else:
+            low, high = limits
+            result = (low <= v) & (v <= high)
+        if result.ndim == 0:
+            return bool(result)
+        return result
 
 
 class USAXS_Q_tool(object):
@@ -100,9 +155,13 @@ class USAXS_Q_tool(object):
             self.motors[motor] = Motor()
 
         self.ui = None
+        self.last_parameters = None     # of the last table recalculation
+        self.scheduler = RecalculationScheduler(self.doRecalculateTable, CALC_ALL_DELAY_MS)
         self.rcfile_name = config_file or DEFAULT_CONFIG_FILE
         self.rcfile = None
         self.doReadConfig()
+        interval = self.rcfile.param.get('recalc_interval_ms', CALC_ALL_DELAY_MS)
+        self.scheduler.interval_ms = int(interval)
         if len(self.rcfile.pvmap) > 0:
             self.pvmap = self.rcfile.pvmap
         else:
@@ -133,6 +192,9 @@ class USAXS_Q_tool(object):
         self.ui.pb_stop.clicked.connect(self.doStop)
         self.ui.pb_stop.setStyleSheet(STOP_BUTTON_STYLES)
 
+        self.ui.w_AY0_user.textChanged.connect(self.scheduler.request)
+        self.ui.w_DY0_user.textChanged.connect(self.scheduler.request)
+
     def _init_epics_controls_(self):
         '''install EPICS motor controls'''
         layout = self.ui.layout_motors
@@ -149,6 +211,12 @@ class USAXS_Q_tool(object):
         for col, motor in enumerate(MOTOR_SYMBOLS):
             build_motor_widgets(motor, col+1)
 
+        # repaint the table (GUI thread) when any motor's limits change
+        self.limits_signal = SignalDef()
+        self.limits_signal.limits.connect(self.doLimitsChanged)
+        for motor in MOTOR_SYMBOLS:
+            self.motors[motor].limits_callback = self.limits_signal.limits.emit
+
     def connect_to_EPICS(self):
         for motor in MOTOR_SYMBOLS:
             obj = self.motors[motor]
@@ -158,8 +226,10 @@ class USAXS_Q_tool(object):
             obj.w_VAL.ca_connect(pvname+'.VAL')
 
         for key, pv in self.rcfile.pvmap.items():
-            self.user_pv[key] = epics.PV(pv, callback=self.doRecalculate)
+            self.user_pv[key] = pv
+            pvCache.subscribe(pv, self.doRecalculate)
             self.user_pv_signal[key] = SignalDef()
+            self.user_pv_signal[key].recalc.connect(self.scheduler.request)
 
     def _replace_standard_controls_(self):
         '''replace standard controls with EPICS controls'''
@@ -207,8 +277,8 @@ class USAXS_Q_tool(object):
         '''(re)build the model/view support'''
         if self.ui is not None:
             self._replace_tableview_(self.rcfile.toDataModel())
-            for key in self.rcfile.pvmap.keys():
-                self.user_pv_signal[key].recalc.connect(self.table.calc_all)
+            self.last_parameters = None     # new table: calculate all of it
+            self.scheduler.request()
 
             #QtCore.QTimer.singleShot(CALC_ALL_DELAY_MS, self.table.calc_all)
 
@@ -276,6 +346,9 @@ class USAXS_Q_tool(object):
         if motor not in MOTOR_SYMBOLS: return
         value, ok = text_value.toDouble()
         if not ok: return
+        if not numpy.isfinite(value):
+            self.setStatus('not moving ' + motor + ' motor: no position (' + str(value) + ')')
+            return
 
         self.setStatus('moving ' + motor + ' motor to ' + str(value))
         self.motors[motor].move(value)
@@ -286,37 +359,53 @@ class USAXS_Q_tool(object):
             key = self.user_pv.keys()[0]            # any key will do
             self.user_pv_signal[key].recalc.emit()  # signal to GUI thread
 
-    def recalculate(self, Q, *args, **kw):
-        '''recompute all terms'''
-        self.setStatus('recalculating ...')
-
-        try:   # get initial parameters from the GUI
-            A_keV = 12.3984244 # Angstrom * keV
+    def parameters(self):
+        '''snapshot of the user parameters from the GUI, None if not available'''
+        try:
             # ar = self.motors['ar'].pv.RBV
-            ar0 = float(self.ui.w_ARenc0.text())
             #arEnc = float(self.ui.w_ARenc.text())
-            sad = float(self.ui.w_SAD.text())
-            sdd = float(self.ui.w_SDD.text())
-            ay0 = float(self.ui.w_AY0_user.text())
-            dy0 = float(self.ui.w_DY0_user.text())
-            energy = float(self.ui.w_energy.text())
-            lambda_over_4pi = A_keV / (energy * 4 * math.pi)
+            return geometry.GeometryParameters(
+                ar0 = float(self.ui.w_ARenc0.text()),
+                sad = float(self.ui.w_SAD.text()),
+                sdd = float(self.ui.w_SDD.text()),
+                ay0 = float(self.ui.w_AY0_user.text()),
+                dy0 = float(self.ui.w_DY0_user.text()),
+                energy = float(self.ui.w_energy.text()),
+            )
         except AttributeError as exc:
-            pass
+            return None     # GUI not built yet
         except Exception as exc:
             self.setStatus('recalc exception 1: ' + str(exc))
             return None
 
-        try:
-            x = -float(Q) * lambda_over_4pi
-            ar = ar0 + 2*math.degrees(math.asin( x ))
-            dy = dy0 + sdd * math.tan( x )
-            ay = ay0 + sad * math.tan( x )
-        except Exception as exc:
-            self.setStatus('recalc exception 2: ' + str(exc))
+    def doLimitsChanged(self):
+        '''(GUI thread) repaint the table buttons with the new limits'''
+        if hasattr(self, 'table'):
+            self.ui.tableView.viewport().update()
+
+    def doRecalculateTable(self):
+        '''(GUI thread, from the scheduler) recalculate the table if the parameters changed'''
+        if not hasattr(self, 'table'):
+            return
+        parameters = self.parameters()
+        if parameters is None or parameters == self.last_parameters:
+            return
+        self.last_parameters = parameters
+        self.table.calc_all()
+
+    def recalculate(self, Q, *args, **kw):
+        '''recompute AR, AY, & DY arrays for an array of Q, from one snapshot of the parameters'''
+        self.setStatus('recalculating ...')
+        params = self.parameters()
+        if params is None:
             return None
 
-        self.setStatus('recalculated')
+        ar, ay, dy = geometry.positions(Q, params)
+        unreachable = numpy.isnan(ar).sum()
+        if unreachable > 0:
+            self.setStatus('recalculated, %d Q value(s) out of range' % unreachable)
+        else:
+            self.setStatus('recalculated')
         return ar, ay, dy
 
     def setStatus(self, message):
@@ -324,12 +413,49 @@ class USAXS_Q_tool(object):
             self.ui.statusBar().showMessage(str(message))
 
 
+class RecalculationScheduler(QtCore.QObject):
+    '''
+    merge bursts of requests into at most one call of ``action`` per interval
+
+    The first request after a quiet interval runs at once (on the next
+    pass of the event loop); requests during the interval are merged
+    into one run at its end.  Call ``request()`` only in the GUI thread.
+    '''
+
+    def __init__(self, action, interval_ms, parent=None):
+        super(RecalculationScheduler, self).__init__(parent)
+        self.action = action
+        self.interval_ms = interval_ms
+        self.last_run = None
+        self.requests = 0
+        self.runs = 0
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self._run)
+
+    def request(self, *args, **kw):
+        self.requests += 1
+        if self.timer.isActive():
+            return      # already scheduled
+        delay_ms = 0
+        if self.last_run is not None:
+            elapsed_ms = 1000 * (time.time() - self.last_run)
+            delay_ms = max(0, self.interval_ms - elapsed_ms)
+        self.timer.start(int(delay_ms))
+
+    def _run(self):
+        self.last_run = time.time()
+        self.runs += 1
+        self.action()
+
+
 class SignalDef(QtCore.QObject):
     '''
     Define signals to communicate between PyEpics and PyQt4 threads
     '''
 
     recalc = pyqtSignal()
+    limits = pyqtSignal()
 
 
 def main():
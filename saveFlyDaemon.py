@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+
+'''
+resident USAXS Fly Scan saver: keeps configuration and EPICS connections warm
+
+Start the daemon once (the XML configuration is parsed and validated
+and all PVs are connected only at this time)::
+
+  saveFlyDaemon.py ./saveFlyData.xml
+
+then, for each fly scan, give the daemon the name of the new data file::
+
+  saveFlyDaemon.py --submit /path/to/new/hdf5/data/file
+
+The client waits until the daemon has written the file and exits with
+the same codes as saveFlyData.py (0=file written, 1=TIMEOUT).
+Any other problem is reported with exit code 2.
+
+Only the user running the daemon can use its socket (mode 0600).
+'''
+
+
+import os
+import socket
+import sys
+
+import saveFlyData
+
+
+DEFAULT_SOCKET_FILE = '/tmp/saveFlyData.socket'
+SOCKET_MODE = 0600      # only the owner may QUIT the daemon or SAVE a file
+EXIT_CODES = {'OK': 0, 'TIMEOUT': 1, 'ERROR': 2}
+
+
+class SaveFlyDaemon(object):
+    '''write one NeXus file per fly scan trigger cycle, file names arrive by Unix socket'''
+
+    def __init__(self, config_file, socket_file = None, streaming = False, timing_log = None,
+                 write_ahead = False):
+        self.socket_file = socket_file or DEFAULT_SOCKET_FILE
+        self.sfs = saveFlyData.SaveFlyScan(None, config_file)
+        self.sfs.streaming = streaming
+        self.sfs.timing_log = timing_log
+        self.sfs.write_ahead = write_ahead
+        self.running = False
+
+    def run(self):
+        '''serve requests, one fly scan at a time, until asked to QUIT'''
+        server = self._open_socket()
+        self.running = True
+        print 'saveFlyDaemon listening on ' + self.socket_file
+        try:
+            while self.running:
+                connection, _address = server.accept()
+                try:
+                    request = connection.makefile('r').readline().strip()
+                    reply = self.handle(request)
+                    connection.sendall(reply + '\n')
+                except socket.error as exc:
+                    print 'client connection lost: ', exc
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            os.remove(self.socket_file)
+
+    def handle(self, request):
+        '''act on one request, return the reply text'''
+        parts = request.split(None, 1)
+        if len(parts) == 0:
+            return 'ERROR empty request'
+        command = parts[0].upper()
+        if command == 'QUIT':
+            self.running = False
+            return 'OK quit'
+        if command == 'SAVE' and len(parts) == 2:
+            return self.save(parts[1])
+        return 'ERROR unknown request: ' + request
+
+    def save(self, dataFile):
+        '''write one data file for the next fly scan'''
+        try:
+            saveFlyData.check_data_file(dataFile)
+            self.sfs.newFile(dataFile)
+            self.sfs.waitForData()
+        except saveFlyData.TimeoutException as exc:
+            self.sfs.closeFile()
+            print 'timeout: ', exc
+            return 'TIMEOUT ' + dataFile
+        except Exception as exc:
+            self.sfs.closeFile()
+            print 'error: ', exc
+            return 'ERROR ' + str(exc)
+        print 'wrote file: ' + dataFile
+        return 'OK ' + dataFile
+
+    def _open_socket(self):
+        '''create the listening socket (owner only), replacing a stale socket file'''
+        if os.path.exists(self.socket_file):
+            try:
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                probe.connect(self.socket_file)
+                probe.close()
+                msg = 'saveFlyDaemon already running on ' + self.socket_file
+                raise RuntimeError, msg
+            except socket.error:
+                os.remove(self.socket_file)     # nobody is listening
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0177)      # no moment with the socket open to other users
+        try:
+            server.bind(self.socket_file)
+        finally:
+            os.umask(umask)
+        os.chmod(self.socket_file, SOCKET_MODE)
+        server.listen(5)
+        return server
+
+
+def submit(request, socket_file = None):
+    '''send one request to the daemon and return its reply'''
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_file or DEFAULT_SOCKET_FILE)
+    try:
+        client.sendall(request + '\n')
+        reply = client.makefile('r').readline().strip()
+    finally:
+        client.close()
+    return reply
+
+
+def get_CLI_options():
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__,
+                    formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('xml_config_file',
+                    action='store',
+                    nargs='?',
+                    help="XML configuration file (starts the daemon)")
+
+    parser.add_argument('--submit',
+                    action='store',
+                    dest='data_file',
+                    help="/path/to/new/hdf5/data/file (sent to the running daemon)")
+
+    parser.add_argument('--quit',
+                    action='store_true',
+                    default=False,
+                    help="stop the running daemon")
+
+    parser.add_argument('--stream',
+                    action='store_true',
+                    default=False,
+                    help="daemon writes PVs marked stream=\"true\" while the scan runs")
+
+    parser.add_argument('--timing-log',
+                    action='store',
+                    default=None,
+                    help="daemon appends the timings of each save as a JSON line to this file")
+
+    parser.add_argument('--write-ahead',
+                    action='store_true',
+                    default=False,
+                    help="daemon flushes each file after each phase (see saveFlyData.py --recover)")
+
+    parser.add_argument('--socket',
+                    action='store',
+                    default=DEFAULT_SOCKET_FILE,
+                    help="Unix socket of the daemon, default: " + DEFAULT_SOCKET_FILE)
+
+    return parser.parse_args()
+
+
+def main():
+    cli_options = get_CLI_options()
+    if cli_options.data_file is not None or cli_options.quit:
+        if cli_options.quit:
+            request = 'QUIT'
+        else:
+            # the daemon may have a different working directory
+            request = 'SAVE ' + os.path.abspath(cli_options.data_file)
+        reply = submit(request, cli_options.socket)
+        print reply
+        sys.exit(EXIT_CODES.get((reply.split() or ['ERROR'])[0], EXIT_CODES['ERROR']))
+
+    configFile = cli_options.xml_config_file
+    if configFile is None:
+        raise RuntimeError, 'need either an XML configuration file or --submit'
+    if not os.path.exists(configFile):
+        msg = 'config file not found: ' + configFile
+        raise RuntimeError, msg
+    SaveFlyDaemon(configFile, cli_options.socket, cli_options.stream,
+                  cli_options.timing_log, cli_options.write_ahead).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,15 @@ save EPICS data from USAXS Fly Scan to a NeXus file
 '''
 
 
+import contextlib
+import cPickle
 import datetime
+import hashlib
+import json
 import os
+import Queue
 import sys
+import threading
 
 # do not warn if the HDF5 library version has changed
 # headers are 1.8.15, library is 1.8.16
@@ -24,50 +30,225 @@ from lxml import etree as lxml_etree
 os.environ['EPICS_CA_MAX_ARRAY_BYTES'] = '1280000'    # was 200000000
 
 import epics		        # PyEpics support
+import pvCache                  # monitored values shared by the tools
 from spec2nexus import eznx     # NeXus r/w support using h5py
 
 
 XML_CONFIGURATION_FILE = 'saveFlyData.xml'
 XSD_SCHEMA_FILE = 'saveFlyData.xsd'
-
-field_registry = {}    # key: node/@label,        value: Field_Specification object
-group_registry = {}    # key: HDF5 absolute path, value: Group_Specification object
-link_registry = {}     # key: node/@label,        value: Link_Specification object
-pv_registry = {}       # key: node/@label,        value: PV_Specification object
-
+COMPILED_CONFIGURATION_SUFFIX = '.compiled'
+COMPILED_CONFIGURATION_FORMAT = '2'     # change when the compiled records change
+PHASES_ATTRIBUTE = 'saveFlyData_phases'    # completed phases, write-ahead mode
+METADATA_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.saveFlyData_metadata.json')
 
 class TimeoutException(Exception): pass
 
 
-def getGroupObjectByXmlNode(xml_node):
-    '''locate a Group_Specification object by matching its xml_node'''
-    for group_spec_obj in group_registry.values():
-        if group_spec_obj.xml_node == xml_node:
-            return group_spec_obj
-    return None
+def compile_configuration(config_file, xsd_file):
+    '''
+    validate and parse the XML configuration file into plain (picklable) records
+
+    Returns a dictionary with the settings (trigger PV, ...) and a list of records
+    for each of the "group", "field", "PV", and "link" elements.
+    Each record keeps the XML attributes of its element, the name/value pairs
+    of its "attribute" child elements, its text (field only), and the HDF5 path
+    of its parent group.  Groups are listed parents first.
+    '''
+    # first, validate configuration file against an XML Schema
+    xmlschema_doc = lxml_etree.parse(xsd_file)
+    xmlschema = lxml_etree.XMLSchema(xmlschema_doc)
+
+    config = lxml_etree.parse(config_file)
+    if not xmlschema.validate(config):
+        # XML file is not valid, let lxml report what is wrong as an exception
+        #log = xmlschema.error_log    # access more details
+        xmlschema.assertValid(config)   # basic exception report
+
+    # safe to proceed parsing the file
+    root = config.getroot()
+    if root.tag != "saveFlyData":
+        raise RuntimeError, "XML file not valid for configuring saveFlyData"
+
+    compiled = dict(version=root.attrib['version'], group=[], field=[], PV=[], link=[])
+
+    trigger_node = root.xpath('/saveFlyData/triggerPV')[0]
+    compiled['trigger_pv'] = trigger_node.attrib['pvname']
+    compiled['trigger_accepted_values'] = (int(trigger_node.attrib['done_value']),
+                                           trigger_node.attrib['done_text'])
+    compiled['trigger_wait_mode'] = trigger_node.get('wait_mode')
+
+    node = root.xpath('/saveFlyData/timeoutPV')[0]
+    compiled['timeout_pv'] = node.attrib['pvname']
+
+    # optional: only the attributes given, SaveFlyScan has the defaults
+    compiled['mca_completion'] = {}
+    for node in root.xpath('/saveFlyData/mcaCompletion'):
+        for key in ('fraction', 'timeout_s', 'settle_s'):
+            if key in node.attrib:
+                compiled['mca_completion'][key] = float(node.attrib[key])
+
+    # pull default poll_interval_s from XML Schema (XSD) file
+    xsd_root = xmlschema_doc.getroot()
+    xsd_node = xsd_root.xpath("//xs:attribute[@name='poll_time_s']", # name="poll_time_s"
+                          namespaces={'xs': 'http://www.w3.org/2001/XMLSchema'})
+
+    # allow XML configuration to override trigger_poll_interval_s
+    default_value = float(xsd_node[0].get('default', SaveFlyScan.trigger_poll_interval_s))
+    compiled['trigger_poll_interval_s'] = float(trigger_node.get('poll_time_s', default_value))
+
+    def walk(xml_node, parent_path):
+        '''one pass through the NX_structure, in document order'''
+        for node in xml_node:
+            if node.tag not in ('group', 'field', 'PV', 'link'):
+                continue        # such as comments
+            record = dict(
+                xml_attrib = dict(node.attrib),
+                attrib = dict([(a.attrib['name'], a.attrib['value']) for a in node.findall('attribute')]),
+                text = '',
+                parent = parent_path,
+            )
+            compiled[node.tag].append(record)
+            if node.tag == 'field':
+                text_node = node.find('text')
+                if text_node is not None:
+                    record['text'] = (text_node.text or '').strip()
+            elif node.tag == 'group':
+                if parent_path is None:
+                    path = '/'
+                else:
+                    path = parent_path
+                    if not path.endswith('/'):
+                        path += '/'
+                    path += node.attrib['name']
+                walk(node, path)
+
+    walk(root.xpath('/saveFlyData/NX_structure')[0], None)
+    return compiled
+
+
+def configuration_hash(config_file, xsd_file):
+    '''identify the content of the configuration (and of the rules that validate it)'''
+    digest = hashlib.sha1(COMPILED_CONFIGURATION_FORMAT)
+    for filename in (config_file, xsd_file):
+        with open(filename, 'rb') as fp:
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def load_configuration(config_file, xsd_file):
+    '''
+    compiled configuration, from the cache file next to the XML file when current
+
+    The cache (``config_file + COMPILED_CONFIGURATION_SUFFIX``) is
+    used only when the content hash of the XML and XSD files matches.
+    Otherwise, the XML file is compiled again and the cache is replaced.
+    '''
+    digest = configuration_hash(config_file, xsd_file)
+    cache_file = config_file + COMPILED_CONFIGURATION_SUFFIX
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as fp:
+                compiled = cPickle.load(fp)
+            if compiled.get('hash') == digest:
+                return compiled
+        except Exception:
+            pass    # unreadable cache: compile again
+
+    compiled = compile_configuration(config_file, xsd_file)
+    compiled['hash'] = digest
+    # write then rename so a concurrent run never reads a partial file
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as fp:
+            cPickle.dump(compiled, fp, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        pass        # directory not writable: compile every time
+    return compiled
+
+
+def parse_storage_options(attrib):
+    '''
+    HDF5 storage options of a PV, from its XML attributes, as keywords for h5py
+
+    ================= ===========================================================
+    XML attribute     meaning
+    ================= ===========================================================
+    chunks            "auto" or number of array elements in each chunk
+    compression       "gzip", "lzf", or "none" (default)
+    compression_level gzip only, 0 (fast) .. 9 (small)
+    shuffle           "true" to apply the byte-shuffle filter before compression
+    dtype             numpy type to store the array, such as "float32" or "uint16"
+    ================= ===========================================================
+    '''
+    storage = {}
+    chunks = attrib.get('chunks')
+    if chunks is not None:
+        storage['chunks'] = True if chunks == 'auto' else (int(chunks),)
+    compression = attrib.get('compression', 'none')
+    if compression != 'none':
+        storage['compression'] = compression
+        if compression == 'gzip' and 'compression_level' in attrib:
+            storage['compression_opts'] = int(attrib['compression_level'])
+    if attrib.get('shuffle', 'false').lower() in ('t', 'true'):
+        storage['shuffle'] = True
+    if 'dtype' in attrib:
+        storage['dtype'] = attrib['dtype']
+    return storage
+
+
+def _fits_dtype(value, dtype):
+    '''
+    can the array be down-cast to dtype without losing any of its values?
+
+    For a floating point dtype, every value must come back unchanged
+    from the cast (no overflow to inf, no lost precision; NaN stays NaN).
+    '''
+    dtype = numpy.dtype(dtype)
+    if value.size == 0:
+        return True
+    if dtype.kind in 'iu':
+        if value.dtype.kind not in 'iu':
+            return False
+        info = numpy.iinfo(dtype)
+        return info.min <= value.min() and value.max() <= info.max
+    if dtype.kind == 'f' and value.dtype.kind in 'iuf':
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            cast = value.astype(dtype)
+            same = (cast == value) | (numpy.isnan(cast) & numpy.isnan(value))
+        return bool(same.all())
+    return numpy.can_cast(value.dtype, dtype)
+
+
+def makeStorageDataset(parent, name, value, storage):
+    '''
+    write an array dataset using the storage options (chunks, filters, dtype)
+
+    Scalars and PVs without storage options are written
+    contiguous, as always, by eznx.makeDataset().
+    The dtype is only applied if every value fits in it.
+    '''
+    if len(storage) == 0 or not isinstance(value, numpy.ndarray) or value.size < 2:
+        return eznx.makeDataset(parent, name, value)
+    kw = dict(storage)
+    dtype = kw.pop('dtype', None)
+    if dtype is not None and _fits_dtype(value, dtype):
+        value = value.astype(dtype)
+    if isinstance(kw.get('chunks'), tuple):
+        # a chunk may not be larger than a fixed-size dataset
+        kw['chunks'] = (min(kw['chunks'][0], len(value)),)
+    return parent.create_dataset(name, data=value, **kw)
 
 
 class Field_Specification(object):
     '''specification of the "field" element in the XML configuration file'''
 
-    def __init__(self, xml_element_node):
-        self.xml_node = xml_element_node
-        xml_parent_node = xml_element_node.getparent()
-        self.group_parent = getGroupObjectByXmlNode(xml_parent_node)
-        self.name = xml_element_node.attrib['name']
+    def __init__(self, record, group_parent):
+        self.group_parent = group_parent
+        self.name = record['xml_attrib']['name']
         self.hdf5_path = self.group_parent.hdf5_path + '/' + self.name
-
-        nodes = xml_element_node.xpath('text')
-        if len(nodes) > 0:
-            self.text = nodes[0].text.strip()
-        else:
-            self.text = ''
-
-        self.attrib = {}
-        for node in xml_element_node.xpath('attribute'):
-            self.attrib[node.attrib['name']] = node.attrib['value']
-
-        field_registry[self.hdf5_path] = self
+        self.text = record['text']
+        self.attrib = record['attrib']
 
     def __str__(self):
         try:
@@ -80,22 +261,16 @@ class Field_Specification(object):
 class Group_Specification(object):
     '''specification of the "group" element in the XML configuration file'''
 
-    def __init__(self, xml_element_node):
+    def __init__(self, record, group_parent):
         self.hdf5_path = None
-        self.xml_node = xml_element_node
-        self.hdf5_group = None
-        self.name = xml_element_node.attrib['name']
-        self.nx_class = xml_element_node.attrib['class']
-
-        self.attrib = {}
-        for node in xml_element_node.xpath('attribute'):
-            self.attrib[node.attrib['name']] = node.attrib['value']
+        self.name = record['xml_attrib']['name']
+        self.nx_class = record['xml_attrib']['class']
+        self.attrib = record['attrib']
 
-        xml_parent_node = xml_element_node.getparent()
         self.group_children = {}
-        if xml_parent_node.tag == 'group':
+        if group_parent is not None:
             # identify our parent
-            self.group_parent = getGroupObjectByXmlNode(xml_parent_node)
+            self.group_parent = group_parent
             # next, find our HDF5 path from our parent
             path = self.group_parent.hdf5_path
             if not path.endswith('/'):
@@ -103,13 +278,9 @@ class Group_Specification(object):
             self.hdf5_path = path + self.name
             # finally, declare ourself to be a child of that parent
             self.group_parent.group_children[self.hdf5_path] = self
-        elif xml_parent_node.tag == 'NX_structure':
+        else:       # child of NX_structure
             self.group_parent = None
             self.hdf5_path = '/'
-        if self.hdf5_path in group_registry:
-            msg = "Cannot create duplicate HDF5 path names: " + self.hdf5_path
-            raise RuntimeError, msg
-        group_registry[self.hdf5_path] = self
 
     def __str__(self):
         return self.hdf5_path or 'Group_Specification object'
@@ -118,23 +289,18 @@ class Group_Specification(object):
 class Link_Specification(object):
     '''specification of the "link" element in the XML configuration file'''
 
-    def __init__(self, xml_element_node):
-        self.xml_node = xml_element_node
-
-        self.name = xml_element_node.attrib['name']
-        self.source_hdf5_path = xml_element_node.attrib['source']   # path to existing object
-        self.linktype = xml_element_node.get('linktype', 'NeXus')
+    def __init__(self, record, group_parent):
+        xml_attrib = record['xml_attrib']
+        self.group_parent = group_parent
+        self.name = xml_attrib['name']
+        self.source_hdf5_path = xml_attrib['source']   # path to existing object
+        self.linktype = xml_attrib.get('linktype', 'NeXus')
         if self.linktype not in ('NeXus', ):
-            msg = "Cannot create HDF5 " + self.linktype + " link: " + self.hdf5_path
+            msg = "Cannot create HDF5 " + self.linktype + " link: " + self.name
             raise RuntimeError, msg
 
-        xml_parent_node = xml_element_node.getparent()
-        self.group_parent = getGroupObjectByXmlNode(xml_parent_node)
-        self.name = xml_element_node.attrib['name']
         self.hdf5_path = self.group_parent.hdf5_path + '/' + self.name
 
-        link_registry[self.hdf5_path] = self
-
     def make_link(self, hdf_file_object):
         '''make this link in the HDF5 file'''
         source = self.source_hdf5_path      # source: existing HDF5 object
@@ -155,27 +321,21 @@ class Link_Specification(object):
 class PV_Specification(object):
     '''specification of the "PV" element in the XML configuration file'''
 
-    def __init__(self, xml_element_node):
-        self.xml_node = xml_element_node
-        self.label = xml_element_node.attrib['label']
-        if self.label in pv_registry:
-            msg = "Cannot use PV label more than once: " + self.label
-            raise RuntimeError, msg
-        self.pvname = xml_element_node.attrib['pvname']
-        self.as_string = xml_element_node.attrib.get('string', "false").lower() in ('t', 'true')
-        self.pv = None
-        aas = xml_element_node.attrib.get('acquire_after_scan', 'false')
+    def __init__(self, record, group_parent):
+        xml_attrib = record['xml_attrib']
+        self.label = xml_attrib['label']
+        self.pvname = xml_attrib['pvname']
+        self.as_string = xml_attrib.get('string', "false").lower() in ('t', 'true')
+        aas = xml_attrib.get('acquire_after_scan', 'false')
         self.acquire_after_scan = aas.lower() in ('t', 'true')
-
-        self.attrib = {}
-        for node in xml_element_node.xpath('attribute'):
-            self.attrib[node.attrib['name']] = node.attrib['value']
+        self.storage = parse_storage_options(xml_attrib)
+        self.stream = xml_attrib.get('stream', 'false').lower() in ('t', 'true')
+        self.attrib = record['attrib']
 
         # identify our parent
-        xml_parent_node = xml_element_node.getparent()
-        self.group_parent = getGroupObjectByXmlNode(xml_parent_node)
+        self.group_parent = group_parent
 
-        self.length_limit = xml_element_node.get('length_limit', None)
+        self.length_limit = xml_attrib.get('length_limit', None)
         if self.length_limit is not None:
             if not self.length_limit.startswith('/'):
                 # convert local to absolute reference
@@ -184,7 +344,6 @@ class PV_Specification(object):
         # finally, declare ourself to be a child of that parent
         self.hdf5_path = self.group_parent.hdf5_path + '/' + self.label
         self.group_parent.group_children[self.hdf5_path] = self
-        pv_registry[self.hdf5_path] = self
 
     def __str__(self):
         try:
@@ -194,201 +353,1210 @@ class PV_Specification(object):
         return nm
 
 
+class ScanConfiguration(object):
+    '''
+    fly scan configuration from one XML file, with indexed registries of its specifications
+
+    Nothing is global, so several configurations (or the same XML file,
+    more than once) may be loaded into one process and compared.
+    Loading is cheap when the compiled configuration is cached.
+    Nothing changes after loading: the PV objects and open HDF5 groups
+    belong to each SaveFlyScan, so one configuration may be shared.
+
+    registries (key: HDF5 absolute path):
+
+    * ``groups``: Group_Specification objects
+    * ``fields``: Field_Specification objects
+    * ``links``: Link_Specification objects
+    * ``pvs``: PV_Specification objects
+
+    indexes of the PV_Specification objects (each value is a list):
+
+    * ``pvs_by_label``: key: PV/@label (same label may be used in different groups)
+    * ``pvs_by_pvname``: key: EPICS PV name (same PV may be written more than once)
+    * ``pvs_by_phase``: key: one of ``PHASES``
+    '''
+
+    PHASES = ('preliminary', 'after_scan')
+
+    def __init__(self, config_file, xsd_file = None):
+        self.config_file = config_file
+        if xsd_file is None:
+            path = os.path.split(os.path.abspath(__file__))[0]
+            xsd_file = os.path.join(path, XSD_SCHEMA_FILE)
+        compiled = load_configuration(config_file, xsd_file)
+
+        self.creator_version = compiled['version']
+        self.trigger_pv = compiled['trigger_pv']
+        self.trigger_accepted_values = compiled['trigger_accepted_values']
+        self.trigger_wait_mode = compiled['trigger_wait_mode']
+        self.timeout_pv = compiled['timeout_pv']
+        self.trigger_poll_interval_s = compiled['trigger_poll_interval_s']
+        self.mca_completion = compiled['mca_completion']
+
+        self.groups = {}
+        self.fields = {}
+        self.links = {}
+        self.pvs = {}
+        self.pvs_by_label = {}
+        self.pvs_by_pvname = {}
+        self.pvs_by_phase = dict([(phase, []) for phase in self.PHASES])
+
+        for record in compiled['group']:
+            parent = self._parent(record)
+            self._register(self.groups, Group_Specification(record, parent))
+
+        for record in compiled['field']:
+            self._register(self.fields, Field_Specification(record, self._parent(record)))
+
+        for record in compiled['PV']:
+            pv_spec = PV_Specification(record, self._parent(record))
+            self._register(self.pvs, pv_spec)
+            self.pvs_by_label.setdefault(pv_spec.label, []).append(pv_spec)
+            self.pvs_by_pvname.setdefault(pv_spec.pvname, []).append(pv_spec)
+            self.pvs_by_phase[self.phase(pv_spec)].append(pv_spec)
+
+        for record in compiled['link']:
+            self._register(self.links, Link_Specification(record, self._parent(record)))
+
+    def _parent(self, record):
+        if record['parent'] is None:
+            return None
+        return self.groups[record['parent']]
+
+    def _register(self, registry, spec):
+        for other in (self.groups, self.fields, self.links, self.pvs):
+            if spec.hdf5_path in other:
+                msg = "Cannot create duplicate HDF5 path names: " + spec.hdf5_path
+                raise RuntimeError, msg
+        registry[spec.hdf5_path] = spec
+
+    def phase(self, pv_spec):
+        '''name of the phase when this PV is written'''
+        if pv_spec.acquire_after_scan:
+            return 'after_scan'
+        return 'preliminary'
+
+    def compare(self, other):
+        '''
+        differences between the PVs of this and another configuration
+
+        returns dictionary of lists of HDF5 paths: added (only in other),
+        removed (only in this), changed (different PV name, phase, or length limit)
+        '''
+        def signature(pv_spec):
+            return (pv_spec.pvname, self.phase(pv_spec), pv_spec.length_limit, pv_spec.as_string)
+
+        mine, theirs = set(self.pvs), set(other.pvs)
+        changed = [path for path in mine & theirs
+                   if signature(self.pvs[path]) != signature(other.pvs[path])]
+        return dict(added = sorted(theirs - mine),
+                    removed = sorted(mine - theirs),
+                    changed = sorted(changed))
+
+
+class PyEpicsBackend(object):
+    '''
+    EPICS Channel Access by PyEpics (production)
+
+    All of SaveFlyScan's EPICS access goes through a backend object.
+    Another backend (such as simEpics.SimulatedBackend) provides the
+    same methods and PV objects with the same attributes.
+    '''
+
+    def PV(self, pvname, **kw):
+        '''create an epics.PV object'''
+        return epics.PV(pvname, **kw)
+
+    def caget(self, pvname, as_string = False, timeout = pvCache.CONNECTION_TIMEOUT_S):
+        '''latest value from the shared monitored PV cache'''
+        return pvCache.get(pvname, as_string=as_string, timeout=timeout)
+
+    def caget_many(self, pvnames, timeout = pvCache.CONNECTION_TIMEOUT_S):
+        '''latest values of many PVs (one wait for all), dictionary {pvname: value}'''
+        values = pvCache.get_many(pvnames, timeout)
+        return dict([(pvname, v.value) for pvname, v in values.items()])
+
+    def caput(self, pvname, value, **kw):
+        return epics.caput(pvname, value, **kw)
+
+    def request(self, pv, count = None):
+        '''issue a CA get for this PV without waiting for the reply'''
+        epics.ca.get(pv.chid, count=count, wait=False)
+
+    def complete(self, pv, count = None, as_string = False, timeout = None):
+        '''wait for the reply to request(), return the value'''
+        return epics.ca.get_complete(pv.chid, count=count, as_string=as_string, timeout=timeout)
+
+    def read(self, pv, count = None, timeout = None):
+        '''CA get of this PV (not from its monitor)'''
+        return epics.ca.get(pv.chid, count=count, timeout=timeout)
+
+    def request_units(self, pv):
+        '''issue a CA get of the control fields (one element) without waiting for the reply'''
+        ftype = epics.ca.promote_type(pv.chid, use_ctrl=True)
+        epics.ca.get_with_metadata(pv.chid, ftype=ftype, count=1, wait=False)
+
+    def complete_units(self, pv, timeout = None):
+        '''wait for the reply to request_units(), return the engineering units ('' if none)'''
+        ftype = epics.ca.promote_type(pv.chid, use_ctrl=True)
+        metadata = epics.ca.get_complete_with_metadata(pv.chid, ftype=ftype, count=1,
+                                                       timeout=timeout)
+        if metadata is None:
+            return ''
+        return metadata.get('units') or ''
+
+
+class EpicsMetadataCache(object):
+    '''
+    persistent cache of EPICS metadata (.DESC, units, field type), key: PV name
+
+    The cache is kept as a JSON file on local disk and is shared between
+    saveFlyData.py runs.  An entry is fetched from EPICS only when it is missing,
+    older than ``ttl_s``, or has been invalidated.
+    '''
+
+    ttl_s = 24*60*60
+
+    def __init__(self, cache_file = None):
+        self.cache_file = cache_file or METADATA_CACHE_FILE
+        self.db = {}
+        self.modified = False
+        self.read()
+
+    def read(self):
+        '''read the cache from disk, start empty if it is missing or unreadable'''
+        self.db = {}
+        if os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file, 'r') as fp:
+                    self.db = json.load(fp)
+            except (IOError, ValueError):
+                pass
+        self.modified = False
+
+    def write(self):
+        '''write the cache to disk (only if it has changed)'''
+        if not self.modified:
+            return
+        # write then rename so a concurrent run never reads a partial file
+        tmp_file = self.cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as fp:
+                json.dump(self.db, fp, indent=2, sort_keys=True)
+            os.rename(tmp_file, self.cache_file)
+            self.modified = False
+        except (IOError, OSError) as exc:
+            print "could not write EPICS metadata cache: ", exc
+
+    def invalidate(self, pvname = None):
+        '''forget the metadata of one PV or (if pvname is None) of all PVs'''
+        if pvname is None:
+            self.db = {}
+        else:
+            self.db.pop(pvname, None)
+        self.modified = True
+
+    def get(self, pv, backend = None):
+        '''metadata for the (connected) PV object, from the cache when possible'''
+        entry = self.db.get(pv.pvname)
+        if entry is None or time.time() - entry['time'] > self.ttl_s:
+            entry = self._fetch(pv, backend or PyEpicsBackend())
+            if pv.connected:        # do not remember metadata of a PV that is not there
+                self.db[pv.pvname] = entry
+                self.modified = True
+        return entry
+
+    def prefetch(self, pvs, backend = None, timeout = pvCache.CONNECTION_TIMEOUT_S):
+        '''
+        fetch the missing or old metadata of all these (connected) PV objects at once
+
+        The control-field (units) requests of all the PVs are issued before
+        any reply is awaited, and the .DESC fields are read together, so the
+        round trips overlap; the replies are collected under one deadline.
+        '''
+        backend = backend or PyEpicsBackend()
+        now = time.time()
+        stale = [pv for pv in pvs
+                 if pv.connected
+                 and now - self.db.get(pv.pvname, dict(time=0))['time'] > self.ttl_s]
+        if len(stale) == 0:
+            return
+        for pv in stale:
+            backend.request_units(pv)
+        descs = backend.caget_many(set([_desc_pvname(pv.pvname) for pv in stale]), timeout)
+        t_end = now + timeout
+        for pv in stale:
+            units = backend.complete_units(pv, timeout=max(t_end - time.time(), pvCache.POLL_INTERVAL_S))
+            desc = descs.get(_desc_pvname(pv.pvname)) or ''
+            self.db[pv.pvname] = dict(desc=desc, units=units, type=pv.type, time=now)
+        self.modified = True
+
+    def _fetch(self, pv, backend):
+        '''get the metadata from EPICS'''
+        if not pv.connected:
+            return dict(desc='', units='', type='', time=time.time())
+        backend.request_units(pv)
+        desc = backend.caget(_desc_pvname(pv.pvname)) or ''
+        units = backend.complete_units(pv, timeout=pvCache.CONNECTION_TIMEOUT_S)
+        return dict(desc=desc, units=units, type=pv.type, time=time.time())
+
+
+def _desc_pvname(pvname):
+    '''name of the .DESC field of the record of this PV'''
+    return os.path.splitext(pvname)[0] + '.DESC'
+
+
+class StreamingPV(object):
+    '''
+    append new elements of an EPICS array PV to a resizable HDF5 dataset during the scan
+
+    Growth is signalled by a CA monitor on the .NORD field.  The data are read
+    only by calls to ``update()``, never from the CA callback.  The appends
+    are queued to the HDF5Writer, which owns the file.
+
+    CA cannot read an array from an offset, so each read transfers
+    the array up to .NORD; only the new elements are appended.
+    If the IOC array shrinks (cleared for a new scan after streaming
+    started), the dataset is emptied and streaming starts again from 0.
+    '''
+
+    chunk_elements = 8192       # default chunk size, unless PV specifies chunks
+    min_growth = 2048           # do not read until this many new elements (unless final)
+
+    def __init__(self, pv_spec, pv, nord_pv, hdf5_parent, backend, writer):
+        self.pv_spec = pv_spec
+        self.pv = pv
+        self.nord_pv = nord_pv
+        self.hdf5_parent = hdf5_parent      # HDF5 group of the dataset
+        self.backend = backend
+        self.writer = writer
+        self.dataset = None
+        self.requested = 0      # elements read from EPICS (and queued for writing)
+        self.written = 0        # elements written to the dataset (by the writer thread)
+        self.error = None       # first exception of a write, later writes are skipped
+        self.restarts = 0       # times the IOC array shrank and streaming started again
+
+    def nord(self):
+        '''number of elements now in the IOC array (from the monitor)'''
+        return int(self.nord_pv.get() or 0)
+
+    def update(self, count = None, final = False, limit = None):
+        '''
+        read the array up to ``count`` (default: .NORD) elements, append what is new
+
+        Only a lower ``count`` (.NORD) means that the IOC array shrank;
+        ``limit`` (length_limit) is applied after that check, the elements
+        already streamed beyond it are trimmed by ``finish()``.
+        '''
+        if count is None:
+            count = self.nord()
+        if count < self.requested:
+            self._restart()
+        if limit is not None:
+            count = min(count, limit)
+        growth = count - self.requested
+        if growth <= 0 or (growth < self.min_growth and not final):
+            return
+        value = self.backend.read(self.pv, count=count, timeout=SaveFlyScan.read_timeout_s)
+        if value is None:
+            return      # try again next time
+        value = numpy.atleast_1d(value)[:count]
+        if len(value) < self.requested:
+            self._restart()     # shrank between .NORD and the read
+        new = value[self.requested:]
+        if len(new) > 0:
+            self.writer.submit(self._append, new)
+            self.requested += len(new)
+
+    def _restart(self):
+        '''the IOC array shrank: drop what was streamed, start again from element 0'''
+        print("%s shrank from %d elements, streaming again" % (self.pv_spec.pvname, self.requested))
+        self.restarts += 1
+        self.requested = 0
+        self.writer.submit(self._truncate)
+
+    def finish(self, length_limit = None):
+        '''read the remaining elements, queue the trim to length_limit'''
+        count = self.nord()
+        self.update(count, final=True, limit=length_limit)
+        if length_limit is not None:
+            count = min(count, length_limit)
+        self.writer.submit(self._trim, count)
+
+    def _trim(self, count):
+        '''(writer thread) trim the dataset to ``count`` elements, create it if empty'''
+        if self.error is not None:
+            return
+        if self.dataset is not None and self.written > count:
+            self.dataset.resize((count,))
+            self.written = count
+        if self.dataset is None:
+            # nothing arrived during the scan, write an empty array
+            self._append(numpy.array([]))
+
+    def _truncate(self):
+        '''(writer thread) drop all the elements written so far'''
+        if self.error is not None:
+            return
+        if self.dataset is not None:
+            self.dataset.resize((0,))
+        self.written = 0
+
+    def _append(self, new):
+        '''(writer thread) append to the dataset, create it first if needed'''
+        if self.error is not None:
+            return
+        try:
+            self._extend(new)
+        except Exception as exc:
+            self.error = exc
+
+    def _extend(self, new):
+        if self.dataset is None:
+            kw = dict(self.pv_spec.storage)
+            kw.pop('dtype', None)       # later values might not fit
+            if not isinstance(kw.get('chunks'), tuple):
+                kw['chunks'] = (self.chunk_elements,)
+            self.dataset = self.hdf5_parent.create_dataset(self.pv_spec.label,
+                                                      data=new,
+                                                      maxshape=(None,),
+                                                      **kw)
+        else:
+            self.dataset.resize((self.written + len(new),))
+            self.dataset[self.written:] = new
+        self.written += len(new)
+
+
+class HDF5Writer(object):
+    '''
+    one thread that owns the HDF5 file and performs the queued writes in order
+
+    The thread reading EPICS puts each write on a bounded queue, then goes on
+    to the next read while the dataset is written.  The queue limits how many
+    values (possibly big arrays) wait in memory.
+
+    An exception in a write is kept (later writes are skipped) and raised
+    again in the calling thread by ``flush()``, ``call()``, or ``close()``.
+    ``close()`` always closes the file, in the writer thread, then stops it.
+    '''
+
+    queue_size = 16
+
+    def __init__(self):
+        self.hdf5_file = None       # set by the first write (which creates the file)
+        self.queue = Queue.Queue(self.queue_size)
+        self.exc_info = None
+        self.thread = threading.Thread(target=self._run, name='HDF5Writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, function, *args, **kw):
+        '''queue ``function(*args, **kw)``, wait only if the queue is full'''
+        if not self.thread.is_alive():
+            raise RuntimeError, 'HDF5 writer has been closed'
+        self.queue.put((function, args, kw))
+
+    def call(self, function, *args, **kw):
+        '''run ``function(*args, **kw)`` in the writer thread, return its result'''
+        result = []
+        self.submit(lambda: result.append(function(*args, **kw)))
+        self.flush()
+        return result[0]
+
+    def flush(self):
+        '''wait until all the queued writes are done'''
+        self.queue.join()
+        self._raise()
+
+    def close(self):
+        '''finish (or skip) the queued writes, close the file, stop the thread'''
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self._raise()
+
+    def _raise(self):
+        if self.exc_info is not None:
+            exc_type, exc_value, exc_traceback = self.exc_info
+            self.exc_info = None
+            raise exc_type, exc_value, exc_traceback
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    if self.hdf5_file is not None and self.hdf5_file.id.valid:
+                        self.hdf5_file.close()      # be CERTAIN to close the file
+                    return
+                if self.exc_info is None:
+                    function, args, kw = task
+                    function(*args, **kw)
+            except Exception:
+                if self.exc_info is None:
+                    self.exc_info = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+
+class SaveTimings(object):
+    '''
+    high-resolution timings of one save: every phase, PV read, and dataset write
+
+    Each record is (kind, name, start_s, duration_s), ``start_s`` measured
+    from the creation of this object.  The kind is "phase", "connect" (name:
+    PV name, duration: connect latency), "read" (name: HDF5 path), "write"
+    (name: HDF5 path), or "stream" (name: HDF5 path).
+    '''
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.records = []
+
+    @contextlib.contextmanager
+    def measure(self, kind, name):
+        '''time the code in this ``with`` block'''
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.add(kind, name, t, time.time() - t)
+
+    def add(self, kind, name, t_start, duration_s):
+        '''record one timing, ``t_start`` is from time.time()'''
+        self.records.append((str(kind), str(name), t_start - self.t0, duration_s))
+
+    def extend(self, other):
+        '''add the records of another SaveTimings (such as the setup before this file)'''
+        for kind, name, start_s, duration_s in other.records:
+            self.add(kind, name, other.t0 + start_s, duration_s)
+
+    def durations(self, kind):
+        '''dictionary of the duration of each record of this kind (key: name), s'''
+        return dict([(name, duration_s)
+                     for record_kind, name, _start_s, duration_s in self.records
+                     if record_kind == kind])
+
+    def phases(self):
+        '''dictionary of the duration of each phase, s'''
+        return self.durations('phase')
+
+    def summary(self):
+        '''dictionary (key: kind) of count, total_s, max_s, and slowest for the non-phase records'''
+        result = {}
+        for kind, name, _start_s, duration_s in self.records:
+            if kind == 'phase':
+                continue
+            stats = result.setdefault(kind, dict(count=0, total_s=0.0, max_s=-1.0, slowest=None))
+            stats['count'] += 1
+            stats['total_s'] += duration_s
+            if duration_s > stats['max_s']:
+                stats['max_s'] = duration_s
+                stats['slowest'] = name
+        return result
+
+    def as_table(self):
+        '''the records as a numpy structured array, one row per record'''
+        kind_length = max([len(r[0]) for r in self.records] + [1])
+        name_length = max([len(r[1]) for r in self.records] + [1])
+        dtype = [('kind', 'S%d' % kind_length),
+                 ('name', 'S%d' % name_length),
+                 ('start_s', 'f8'),
+                 ('duration_s', 'f8')]
+        return numpy.array(self.records, dtype=dtype)
+
+    def write(self, hdf5_parent, name = 'timings'):
+        '''write the records as a compound dataset, return the dataset'''
+        ds = hdf5_parent.create_dataset(name, data=self.as_table())
+        t = datetime.datetime.fromtimestamp(self.t0)
+        eznx.addAttributes(ds,
+          units = 's',
+          start_time = str(t),
+          description = 'timings of the phases, PV connections, PV reads, and dataset writes of this save',
+          note = 'written before the file is closed: the close phase is only in the timing log',
+        )
+        return ds
+
+    def log(self, log_file, **items):
+        '''append the phases, connect latencies, summary, and any other items as one JSON line'''
+        entry = dict(items)
+        entry['start_time'] = str(datetime.datetime.fromtimestamp(self.t0))
+        entry['phases'] = self.phases()
+        entry['summary'] = self.summary()
+        connect = self.durations('connect')
+        if len(connect) > 0:
+            entry['connect'] = connect
+        with open(log_file, 'a') as fp:
+            fp.write(json.dumps(entry, sort_keys=True) + '\n')
+
+
 class SaveFlyScan(object):
     '''watch trigger PV, save data to NeXus file after scan is done'''
 
     trigger_pv = '9idcLAX:USAXSfly:Start'
     trigger_accepted_values = (0, 'Done')
     trigger_poll_interval_s = 0.1
+    trigger_wait_mode = 'monitor'       # 'monitor' (CA monitor callbacks) or 'poll'
+    connection_timeout_s = 5.0
+    read_timeout_s = 5.0
+    connection_poll_interval_s = 0.01
     mca_data_wait_interval_s = 0.01
-    mca_data_wait_timeout_s = 10.0
+    mca_data_wait_timeout_s = 10.0     # give up if no MCA array grows for this long
+    mca_data_wait_settle_s = 0.2       # no growth for this long: complete (if above fraction)
+    mca_data_acceptable_fraction = 0.5
+    mca_channels_path = '/entry/flyScan/mca_channels'
+    mca_channels_used_path = '/entry/flyScan/mca_channels_used'
+    mca_array_paths = ('/entry/flyScan/mca1', '/entry/flyScan/mca2', '/entry/flyScan/mca3')
     scantime_pv = '9idcLAX:USAXS:FS_ScanTime'
     creator_version = 'unknown'
+    streaming = False       # write PVs marked stream="true" while the scan runs
+    timing_log = None       # append the timings of each save as a JSON line to this file
+    write_ahead = False     # flush the file and record each phase as it completes
+    diagnostics_group = 'diagnostics'   # NXcollection (in the NXentry) for the timings
     flyScanNotSaved_pv = '9idcLAX:USAXS:FlyScanNotSaved'
 
-    def __init__(self, hdf5_file, config_file = None):
+    def __init__(self, hdf5_file, config_file = None, metadata_cache = None, configuration = None,
+                 backend = None, verbose = False):
         self.hdf5_file_name = hdf5_file
+        self.verbose = verbose      # report the connect latency of each PV
+        self.backend = backend or PyEpicsBackend()
+        self.metadata_cache = metadata_cache or EpicsMetadataCache()
         path = self._get_support_code_dir()
         self.config_file = config_file or os.path.join(path, XML_CONFIGURATION_FILE)
-        self._read_configuration()
+        self.config = configuration
+        self.trigger = None
+        # runtime handles, the configuration is not changed (it may be shared)
+        self.pvs = {}           # PV objects, key: HDF5 path of the PV_Specification
+        self.hdf5_groups = {}   # open HDF5 groups of the current file, key: HDF5 path of the group
+        self.nord_pvs = {}
+        self.streams = {}
+        self.writer = None      # owns the HDF5 file while it is open
+        self.trigger_to_close_s = None
+        self.mca_wait = {}       # statistics of the last wait for MCA data
+        self.setup_timings = SaveTimings()     # before the file is created
+        self.timings = None                    # of the current file
+        self._event = threading.Condition()
+        self._signalled = False
+        with self.setup_timings.measure('phase', 'config'):
+            self._read_configuration()
         self._prepare_to_acquire()
 
+    def newFile(self, hdf5_file):
+        '''start another HDF5 file, re-using the configuration and PV connections'''
+        self.hdf5_file_name = hdf5_file
+        self._create_file()
+
+    def recoverFile(self, hdf5_file):
+        '''
+        finish a file left incomplete by an interrupted save (written in write-ahead mode)
+
+        The file is opened again and only the PVs without a complete dataset
+        (one with its EPICS attributes) and the missing links are written.
+        The acquire_after_scan PVs still hold the values of the last scan
+        until the next scan starts.  Returns the list of HDF5 paths written.
+        '''
+        self.closeFile()
+        self.hdf5_file_name = hdf5_file
+        self.timings = SaveTimings()
+        self.writer = HDF5Writer()
+        phases = self.writer.call(self._open_structure)
+        if 'complete' in phases:
+            self.closeFile()
+            print 'file is complete: ' + hdf5_file
+            return []
+
+        pv_specs = self.writer.call(self._incomplete_PVs)
+        for pv_spec in pv_specs:
+            if not pv_spec.acquire_after_scan:
+                print 'WARNING: preliminary PV read after the scan: ' + pv_spec.hdf5_path
+        for pv_spec, value in self._read_PVs(pv_specs):
+            self._write_PV(pv_spec, value)
+        self.writer.submit(self._record_phase, 'recovered')
+        self.writer.submit(self._make_links, True)
+        self.writer.submit(self._record_phase, 'complete')
+        writer, self.writer = self.writer, None
+        writer.close()
+        self.metadata_cache.write()
+        self.backend.caput(self.flyScanNotSaved_pv, 0)
+        return [pv_spec.hdf5_path for pv_spec in pv_specs]
+
+    def closeFile(self):
+        '''close the HDF5 file if it is still open (such as after an exception)'''
+        if self.writer is None:
+            return
+        writer, self.writer = self.writer, None
+        try:
+            writer.close()
+        except Exception as exc:
+            print "ERROR while closing the HDF5 file: ", exc
+
     def waitForData(self):
         '''wait until the data is ready, then save it'''
-        self.trigger = epics.PV(self.trigger_pv)
-        epics.caput(self.flyScanNotSaved_pv, 1)
+        if self.trigger is None:
+            self.trigger = self.backend.PV(self.trigger_pv, callback=self._notify)
+            self.trigger.wait_for_connection()
+        self.backend.caput(self.flyScanNotSaved_pv, 1)
+        timings = self.timings
+        self.mca_wait = {}
+        self._complete_phase('created')
+
+        with timings.measure('phase', 'preliminary'):
+            self.preliminaryWriteFile()    # file is already open, write preliminary data
+        self._complete_phase('preliminary')
+        self._start_streams()
+
+        with timings.measure('phase', 'trigger_wait'):
+            self._wait_for(self._trigger_is_done,
+                           poll_interval_s=self.trigger_poll_interval_s,
+                           work=self._update_streams)
+        t_done = time.time()
+
+        with timings.measure('phase', 'mca_wait'):
+            self._waitForMcaData()
 
-        self.preliminaryWriteFile()        # file is already open, write preliminary data
-
-        while self.trigger.get() not in self.trigger_accepted_values:
-            time.sleep(self.trigger_poll_interval_s)
-        
-        # check that all MCA arrays are filled. mca3 particularly (also mca1 & mca2)
+        self.saveFile()                    # write the remaining data and close the file
+        self.trigger_to_close_s = time.time() - t_done
+        print("trigger done to file closed: %.3f s" % self.trigger_to_close_s)
+        if self.timing_log is not None:
+            timings.log(self.timing_log,
+                        file = self.hdf5_file_name,
+                        trigger_to_close_s = self.trigger_to_close_s,
+                        mca_wait = self.mca_wait)
+        self.backend.caput(self.flyScanNotSaved_pv, 0)
+
+    def _waitForMcaData(self):
+        '''
+        wait until the MCA arrays are complete, raise TimeoutException if they stall short
+
+        The .NORD (number of elements read into the array) of each array
+        is watched (its monitor was connected with all the other PVs).
+        An array served from its own monitor is judged by the length of
+        that monitored value, the same data that will be written.
+        Before the wait ends, the .NORD of each of the other arrays is
+        read again (CA get, not the monitor) and the wait goes on if it
+        moved.  The data are complete when every array has all the
+        channels (CurrentChannel) or all the channels used (NuseAll), or when
+        every array has at least the acceptable fraction of the channels and
+        none has grown for ``mca_data_wait_settle_s``.  The wait gives up when
+        no array has grown for ``mca_data_wait_timeout_s``, so a slow IOC that
+        is still advancing is not cut off.  Statistics are kept in ``self.mca_wait``.
+        '''
         # .NORD (count) is number of elements read into the array
         # .NELM (nelm) is the (maximum) number of elements in the array
-        # pv_registry['/entry/flyScan/mca3'].pv.count
-        current_channel = pv_registry['/entry/flyScan/mca_channels'].pv.value
-        acceptable_fraction = 0.5
+        pv_s = [self._pv(self.config.pvs[path]) for path in self.mca_array_paths]
+        nord_pvs = [None] * len(pv_s)
+        if self.trigger_wait_mode == 'monitor':
+            nord_pvs = [self._nord_pv(pv.pvname) for pv in pv_s]
+
+        def array_count(pv, nord_pv, fresh = False):
+            if nord_pv is None or not nord_pv.connected or pv.auto_monitor:
+                return pv.count     # the array itself (from its monitor, if it has one)
+            if fresh:
+                return int(self.backend.read(nord_pv, timeout=self.read_timeout_s) or 0)
+            return int(nord_pv.get() or 0)
+
+        counts = lambda fresh = False: [array_count(pv, nord_pv, fresh)
+                                        for pv, nord_pv in zip(pv_s, nord_pvs)]
+        channels = self._get_int(self.mca_channels_path)
+        channels_used = self._get_int(self.mca_channels_used_path)
         # choice of acceptable_fraction is somewhat arbitrary
         # allows for some channel advances to be missed
-        acceptable_count = int(current_channel * acceptable_fraction)
-        pv_s = [pv_registry['/entry/flyScan/'+s].pv for s in "mca1 mca2 mca3".split()]
+        acceptable_count = int(channels * self.mca_data_acceptable_fraction)
+
         t0 = time.time()
-        t_end = t0 + self.mca_data_wait_timeout_s
-        while min([pv.count for pv in pv_s]) < acceptable_count:
-            if time.time() > t_end:
-                elapsed = time.time() - t0
-                emsg = "Waited %.2f s" % elapsed
-                emsg += " for at least %d channels from every MCA" % acceptable_count
-                emsg += " received only %s for [mca1, mca2, mca3]" % str([pv.count for pv in pv_s])
-                raise TimeoutException(emsg)
-            time.sleep(self.mca_data_wait_interval_s)
+        state = dict(counts = counts(), t_growth = t0, reason = None)
+        initial_count = min(state['counts'])
+
+        def complete():
+            now = time.time()
+            current = counts()
+            if current != state['counts']:
+                state['counts'] = current
+                state['t_growth'] = now
+            n = min(current)
+            stalled_s = now - state['t_growth']
+            if n >= channels > 0:
+                state['reason'] = 'all channels'
+            elif n >= channels_used > 0:
+                state['reason'] = 'channels used'
+            elif n >= acceptable_count and stalled_s >= self.mca_data_wait_settle_s:
+                state['reason'] = 'settled'
+            elif stalled_s >= self.mca_data_wait_timeout_s:
+                state['reason'] = 'stalled'
+            if state['reason'] not in (None, 'stalled'):
+                confirmed = counts(fresh=True)
+                if confirmed != current:
+                    # monitor was behind the array: growth, not complete
+                    state['counts'] = confirmed
+                    state['t_growth'] = time.time()
+                    state['reason'] = None
+            return state['reason'] is not None
+
+        # each wait is short so that a stall is noticed without a new monitor event
+        settle_s = max(self.mca_data_wait_settle_s, self.mca_data_wait_interval_s)
+        while not self._wait_for(complete,
+                                 timeout_s=settle_s,
+                                 poll_interval_s=self.mca_data_wait_interval_s,
+                                 work=self._update_streams):
+            pass
         elapsed = time.time() - t0
-        if self.mca_data_wait_interval_s < elapsed <= self.mca_data_wait_timeout_s:
+
+        self.mca_wait = dict(
+            reason = state['reason'],
+            wait_s = elapsed,
+            counts = state['counts'],
+            channels = channels,
+            channels_used = channels_used,
+            acceptable_count = acceptable_count,
+            growth_rate = (min(state['counts']) - initial_count) / max(elapsed, 1e-9),
+        )
+        if state['reason'] == 'stalled':
+            emsg = "Waited %.2f s" % elapsed
+            emsg += " for at least %d channels from every MCA" % acceptable_count
+            emsg += " received only %s for %s" % (str(state['counts']), str(list(self.mca_array_paths)))
+            raise TimeoutException(emsg)
+        if elapsed > self.mca_data_wait_interval_s:
             # had to wait, report how long it took
-            msg = "Waited %.2f s for MCA data to be read" % elapsed
+            msg = "Waited %.2f s for MCA data to be read (%s)" % (elapsed, state['reason'])
             print(msg)
 
-        self.saveFile()                    # write the remaining data and close the file
-        epics.caput(self.flyScanNotSaved_pv, 0)
+    def _get_int(self, hdf5_path):
+        '''value of a (monitored) scalar PV as an integer, 0 if not available'''
+        pv_spec = self.config.pvs.get(hdf5_path)
+        if pv_spec is None or not self._pv(pv_spec).connected:
+            return 0
+        try:
+            return int(self._pv(pv_spec).get() or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def _trigger_is_done(self):
+        return self.trigger.get() in self.trigger_accepted_values
+
+    def _nord_pvnames(self):
+        '''names of the arrays whose .NORD is monitored: the MCA arrays and those to stream'''
+        names = [self.config.pvs[path].pvname for path in self.mca_array_paths
+                 if path in self.config.pvs]
+        names += [pv_spec.pvname for pv_spec in self.config.pvs_by_phase['after_scan']
+                  if pv_spec.stream]
+        return sorted(set(names))
+
+    def _nord_pv(self, pvname):
+        '''monitored .NORD PV of an array (created in _connect_PVs, never waited for here)'''
+        if pvname not in self.nord_pvs:
+            self.nord_pvs[pvname] = self.backend.PV(pvname + '.NORD', callback=self._notify)
+        return self.nord_pvs[pvname]
+
+    def _start_streams(self):
+        '''start streaming the array PVs marked stream="true" (if streaming)'''
+        self.streams = {}
+        if not self.streaming:
+            return
+        for pv_spec in self.config.pvs_by_phase['after_scan']:
+            if pv_spec.stream and self._pv(pv_spec).connected:
+                nord_pv = self._nord_pv(pv_spec.pvname)
+                if nord_pv.connected:
+                    self.streams[pv_spec.hdf5_path] = StreamingPV(pv_spec, self._pv(pv_spec), nord_pv,
+                                                                  self._parent_group(pv_spec),
+                                                                  self.backend, self.writer)
+
+    def _pv(self, pv_spec):
+        '''PV object (of this SaveFlyScan) for the PV_Specification'''
+        return self.pvs[pv_spec.hdf5_path]
+
+    def _parent_group(self, spec):
+        '''open HDF5 group (of the current file) of the parent of a specification'''
+        return self.hdf5_groups[spec.group_parent.hdf5_path]
+
+    def _update_streams(self):
+        '''append any new data of the streaming PVs to the file'''
+        for stream in self.streams.values():
+            t = time.time()
+            requested = stream.requested
+            stream.update()
+            if stream.requested > requested:
+                self.timings.add('stream', stream.pv_spec.hdf5_path, t, time.time() - t)
+
+    def _notify(self, **kw):
+        '''CA monitor callback (or deadline timer): wake up the thread in _wait_for()'''
+        with self._event:
+            self._signalled = True
+            self._event.notify_all()
+
+    def _wait_for(self, predicate, timeout_s = None, poll_interval_s = 0.1, work = None):
+        '''
+        wait until ``predicate()`` is True, return False if ``timeout_s`` expires first
+
+        In "monitor" mode, this thread sleeps on a condition variable
+        and is woken by the CA monitor callbacks (and by a timer at the deadline).
+        In "poll" mode, ``predicate()`` is tested every ``poll_interval_s``.
+        Each time this thread wakes, ``work()`` (if given) is called first.
+
+        Neither ``predicate()`` nor ``work()`` is called with the lock held
+        since a CA callback that waits for the lock would block CA I/O.
+        '''
+        t_end = None
+        if timeout_s is not None:
+            t_end = time.time() + timeout_s
+        if self.trigger_wait_mode == 'poll':
+            while True:
+                if work is not None:
+                    work()
+                if predicate():
+                    return True
+                if t_end is not None and time.time() > t_end:
+                    return False
+                time.sleep(poll_interval_s)
+
+        timer = None
+        if timeout_s is not None:
+            # wait() without a timeout: Python 2 implements a timed wait by polling
+            timer = threading.Timer(timeout_s, self._notify)
+            timer.start()
+        try:
+            while True:
+                with self._event:
+                    self._signalled = False
+                if work is not None:
+                    work()
+                if predicate():
+                    return True
+                if t_end is not None and time.time() >= t_end:
+                    return False
+                with self._event:
+                    if not self._signalled:     # nothing happened since we looked
+                        self._event.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
 
     def preliminaryWriteFile(self):
         '''write all preliminary data to the file while fly scan is running'''
-        for pv_spec in pv_registry.values():
-            if pv_spec.acquire_after_scan:
-                continue
-            if pv_spec.as_string:
-                value = pv_spec.pv.get(as_string=True)
-            else:
-                value = pv_spec.pv.get()
-            if value is [None]:
-                value = 'no data'
-            if not isinstance(value, numpy.ndarray):
-                value = [value]
-            else:
-                if pv_spec.length_limit and pv_spec.length_limit in pv_registry:
-                    length_limit = pv_registry[pv_spec.length_limit].pv.get()
-                    if len(value) > length_limit:
-                        value = value[:length_limit]
-
-            hdf5_parent = pv_spec.group_parent.hdf5_group
-            try:
-                ds = eznx.makeDataset(hdf5_parent, pv_spec.label, value)
-                self._attachEpicsAttributes(ds, pv_spec.pv)
-                eznx.addAttributes(ds, **pv_spec.attrib)
-            except Exception as e:
-                print "ERROR: ", pv_spec.label, value
-                print "MESSAGE: ", e
-                print "RESOLUTION: writing as error message string"
-                eznx.makeDataset(hdf5_parent, pv_spec.label, [str(e)])
-                #raise
+        for pv_spec, value in self._read_PVs(self.config.pvs_by_phase['preliminary']):
+            self._write_PV(pv_spec, value)
 
     def saveFile(self):
         '''write all desired data to the file and exit this code'''
         t = datetime.datetime.now()
         #timestamp = ' '.join((t.strftime("%Y-%m-%d"), t.strftime("%H:%M:%S")))
         timestamp = str(t).split('.')[0]
-        f = group_registry['/'].hdf5_group
-        eznx.addAttributes(f, timestamp = timestamp)
+        f = self.hdf5_groups['/']
+        self.writer.submit(eznx.addAttributes, f, timestamp = timestamp)
+        timings = self.timings
 
         # TODO: will len(caget(array)) = NORD or NELM? (useful data or full array)
-        for pv_spec in pv_registry.values():
-            if not pv_spec.acquire_after_scan:
-                continue
-            if pv_spec.as_string:
-                value = pv_spec.pv.get(as_string=True)
+        pv_specs = [pv_spec for pv_spec in self.config.pvs_by_phase['after_scan']
+                    if pv_spec.hdf5_path not in self.streams]
+        with timings.measure('phase', 'after_scan'):
+            for pv_spec, value in self._read_PVs(pv_specs):
+                self._write_PV(pv_spec, value)
+        with timings.measure('phase', 'finish_streams'):
+            for stream in self.streams.values():
+                self._finish_stream(stream)
+        with timings.measure('phase', 'write_wait'):
+            self.writer.flush()
+        self._complete_phase('after_scan')
+
+        # as the final step, make all the links as directed
+        self.writer.submit(self._make_links)
+        self._complete_phase('links')
+        # the timings table is the last write: the close phase is only in the timing log
+        self.writer.submit(self._write_timings)
+        self._complete_phase('complete')
+        with timings.measure('phase', 'close'):
+            writer, self.writer = self.writer, None
+            writer.close()
+        self.metadata_cache.write()
+
+    def _make_links(self, only_missing = False):
+        '''(writer thread) make all the links as directed'''
+        f = self.hdf5_groups['/']
+        with self.timings.measure('phase', 'links'):
+            for _k, v in self.config.links.items():
+                if not (only_missing and v.hdf5_path in f):
+                    v.make_link(f)
+
+    def _complete_phase(self, phase):
+        '''write-ahead mode: queue the flush and record of a completed phase'''
+        if self.write_ahead:
+            self.writer.submit(self._record_phase, phase)
+
+    def _record_phase(self, phase):
+        '''(writer thread) flush the file, then add the phase to its completed phases'''
+        f = self.hdf5_groups['/']
+        f.flush()       # data of the phase are on disk before it is recorded
+        phases = str(f.attrs.get(PHASES_ATTRIBUTE, '')).split()
+        f.attrs[PHASES_ATTRIBUTE] = ' '.join(phases + [phase])
+        f.flush()
+
+    def _open_structure(self):
+        '''(writer thread) open an existing HDF5 file, add any missing groups and fields'''
+        f = h5py.File(self.hdf5_file_name, 'r+')
+        self.writer.hdf5_file = f
+        self.hdf5_groups = {}
+        if PHASES_ATTRIBUTE not in f.attrs:
+            msg = 'not written in write-ahead mode, cannot recover: ' + self.hdf5_file_name
+            raise RuntimeError, msg
+        for key, xture in sorted(self.config.groups.items()):
+            if key == '/':
+                self.hdf5_groups[key] = f
+            elif key in f:
+                self.hdf5_groups[key] = f[key]
             else:
-                value = pv_spec.pv.get()
-            if value is [None]:
-                value = 'no data'
-            if not isinstance(value, numpy.ndarray):
-                value = [value]
+                hdf5_parent = self._parent_group(xture)
+                self.hdf5_groups[key] = eznx.makeGroup(hdf5_parent, xture.name, xture.nx_class)
+                eznx.addAttributes(self.hdf5_groups[key], **xture.attrib)
+        for field in self.config.fields.values():
+            if field.hdf5_path not in f:
+                ds = eznx.makeDataset(self._parent_group(field), field.name, [field.text])
+                eznx.addAttributes(ds, **field.attrib)
+        return str(f.attrs[PHASES_ATTRIBUTE]).split()
+
+    def _incomplete_PVs(self):
+        '''(writer thread) PVs without a complete dataset, incomplete datasets are removed'''
+        f = self.hdf5_groups['/']
+        pv_specs = []
+        for phase in self.config.PHASES:
+            for pv_spec in self.config.pvs_by_phase[phase]:
+                path = pv_spec.hdf5_path
+                if path in f and 'epics_pv' in f[path].attrs:
+                    continue    # EPICS attributes are written last
+                if path in f:
+                    del f[path]     # such as an array cut short while streaming
+                pv_specs.append(pv_spec)
+        return pv_specs
+
+    def _write_timings(self):
+        '''(writer thread) write the timings table and MCA wait statistics to the diagnostics group'''
+        group = self._diagnostics_group()
+        self.timings.write(group)
+        if len(self.mca_wait) > 0:
+            mca_wait = eznx.makeGroup(group, 'mca_wait', 'NXcollection')
+            for key, value in sorted(self.mca_wait.items()):
+                eznx.makeDataset(mca_wait, key, [value] if numpy.isscalar(value) else value)
+
+    def _diagnostics_group(self):
+        '''(writer thread) NXcollection for the timings, in the (first) NXentry of the file'''
+        f = self.hdf5_groups['/']
+        entries = sorted([path for path, group in self.config.groups.items()
+                          if group.nx_class == 'NXentry'])
+        parent = f
+        if len(entries) > 0:
+            parent = self.hdf5_groups[entries[0]]
+        if self.diagnostics_group in parent:
+            return parent[self.diagnostics_group]
+        return eznx.makeGroup(parent, self.diagnostics_group, 'NXcollection')
+
+    def _read_PVs(self, pv_specs):
+        '''
+        read the values of these PVs, generate (pv_spec, value) as each is read
+
+        Monitored PVs (scalars and short arrays) are served from their monitors.
+        For the other (big) arrays, all CA requests are issued together
+        before waiting for any reply, so the transfers overlap.
+        An array with a ``length_limit`` is requested with only that many
+        elements, so nothing needs to be sliced off afterwards.
+        '''
+        pending = []
+        for pv_spec in pv_specs:
+            pv = self._pv(pv_spec)
+            length_limit = self._get_length_limit(pv_spec)
+            t = time.time()
+            if not pv.connected:
+                yield pv_spec, 'not connected'
+            elif pv.auto_monitor:
+                value = pv.get(as_string=pv_spec.as_string)
+                if isinstance(value, numpy.ndarray) and length_limit is not None:
+                    value = value[:length_limit]
+                self.timings.add('read', pv_spec.hdf5_path, t, time.time() - t)
+                yield pv_spec, value
             else:
-                if pv_spec.length_limit and pv_spec.length_limit in pv_registry:
-                    length_limit = pv_registry[pv_spec.length_limit].pv.get()
-                    if len(value) > length_limit:
-                        value = value[:length_limit]
-
-            hdf5_parent = pv_spec.group_parent.hdf5_group
-            try:
-                ds = eznx.makeDataset(hdf5_parent, pv_spec.label, value)
-                self._attachEpicsAttributes(ds, pv_spec.pv)
-                eznx.addAttributes(ds, **pv_spec.attrib)
-            except Exception as e:
-                print "ERROR: ", pv_spec.label, value
-                print "MESSAGE: ", e
+                self.backend.request(pv, count=length_limit)
+                pending.append((pv_spec, length_limit, t))
+
+        for pv_spec, length_limit, t in pending:
+            value = self.backend.complete(self._pv(pv_spec),
+                                          count=length_limit,
+                                          as_string=pv_spec.as_string,
+                                          timeout=self.read_timeout_s)
+            # from request to reply: the transfers overlap
+            self.timings.add('read', pv_spec.hdf5_path, t, time.time() - t)
+            yield pv_spec, value
+
+    def _get_length_limit(self, pv_spec):
+        '''number of array elements to keep, None to keep all of them'''
+        if pv_spec.length_limit and pv_spec.length_limit in self.config.pvs:
+            limit_pv = self._pv(self.config.pvs[pv_spec.length_limit])
+            if limit_pv.connected:
+                length_limit = limit_pv.get()
+                if length_limit is not None and int(length_limit) > 0:
+                    return min(int(length_limit), self._pv(pv_spec).nelm or int(length_limit))
+        return None
+
+    def _finish_stream(self, stream):
+        '''read the remaining data of a streamed PV, queue the writes of it and its attributes'''
+        pv_spec = stream.pv_spec
+        error = None
+        try:
+            stream.finish(self._get_length_limit(pv_spec))
+        except Exception as e:
+            error = e
+        metadata = self.metadata_cache.get(self._pv(pv_spec), self.backend)
+        self.writer.submit(self._finish_stream_dataset, stream, metadata, error)
+
+    def _finish_stream_dataset(self, stream, metadata, error):
+        '''(writer thread) attach the attributes to a streamed dataset'''
+        pv_spec = stream.pv_spec
+        error = error or stream.error
+        try:
+            if error is not None:
+                raise error
+            ds = stream.dataset
+            self._attachEpicsAttributes(ds, self._pv(pv_spec), metadata)
+            eznx.addAttributes(ds, **pv_spec.attrib)
+        except Exception as e:
+            print "ERROR: ", pv_spec.label, "(streamed)"
+            print "MESSAGE: ", e
+            if stream.dataset is None:
                 print "RESOLUTION: writing as error message string"
-                eznx.makeDataset(hdf5_parent, pv_spec.label, [str(e)])
-                #raise
-
-        # as the final step, make all the links as directed
-        for _k, v in link_registry.items():
-            v.make_link(f)
-
-        f.close()    # be CERTAIN to close the file
+                eznx.makeDataset(self._parent_group(pv_spec), pv_spec.label, [str(e)])
+
+    def _write_PV(self, pv_spec, value):
+        '''queue the write of the value of a PV as a dataset with its attributes'''
+        # any CA access for the metadata happens here, not in the writer thread
+        metadata = self.metadata_cache.get(self._pv(pv_spec), self.backend)
+        self.writer.submit(self._write_dataset, pv_spec, value, metadata)
+
+    def _write_dataset(self, pv_spec, value, metadata):
+        '''(writer thread) write the value of a PV as a dataset with its attributes'''
+        if value is None:
+            value = 'no data'
+        if not isinstance(value, numpy.ndarray):
+            value = [value]
+
+        hdf5_parent = self._parent_group(pv_spec)
+        t = time.time()
+        try:
+            ds = makeStorageDataset(hdf5_parent, pv_spec.label, value, pv_spec.storage)
+            self._attachEpicsAttributes(ds, self._pv(pv_spec), metadata)
+            eznx.addAttributes(ds, **pv_spec.attrib)
+            self.timings.add('write', pv_spec.hdf5_path, t, time.time() - t)
+        except Exception as e:
+            print "ERROR: ", pv_spec.label, value
+            print "MESSAGE: ", e
+            print "RESOLUTION: writing as error message string"
+            eznx.makeDataset(hdf5_parent, pv_spec.label, [str(e)])
+            #raise
 
     def _read_configuration(self):
-        # first, validate configuration file against an XML Schema
-        path = self._get_support_code_dir()
-        xml_schema_file = os.path.join(path, XSD_SCHEMA_FILE)
-        xmlschema_doc = lxml_etree.parse(xml_schema_file)
-        xmlschema = lxml_etree.XMLSchema(xmlschema_doc)
-
-        config = lxml_etree.parse(self.config_file)
-        if not xmlschema.validate(config):
-            # XML file is not valid, let lxml report what is wrong as an exception
-            #log = xmlschema.error_log    # access more details
-            xmlschema.assertValid(config)   # basic exception report
-
-        # safe to proceed parsing the file
-        root = config.getroot()
-        if root.tag != "saveFlyData":
-            raise RuntimeError, "XML file not valid for configuring saveFlyData"
-
-        self.creator_version = root.attrib['version']
-
-        node = root.xpath('/saveFlyData/triggerPV')[0]
-        self.trigger_pv = node.attrib['pvname']
-        acceptable_values = (int(node.attrib['done_value']), node.attrib['done_text'])
-        self.trigger_accepted_values = acceptable_values
-
-        node = root.xpath('/saveFlyData/timeoutPV')[0]
-        self.timeout_pv = node.attrib['pvname']
-
-        # initial default value set in this code
-        # pull default poll_interval_s from XML Schema (XSD) file
-        xsd_root = xmlschema_doc.getroot()
-        xsd_node = xsd_root.xpath("//xs:attribute[@name='poll_time_s']", # name="poll_time_s"
-                              namespaces={'xs': 'http://www.w3.org/2001/XMLSchema'})
-
-        # allow XML configuration to override trigger_poll_interval_s
-        default_value = float(xsd_node[0].get('default', self.trigger_poll_interval_s))
-        self.trigger_poll_interval_s = node.get('poll_time_s', default_value)
-
-        nx_structure = root.xpath('/saveFlyData/NX_structure')[0]
-        for node in nx_structure.xpath('//group'):
-            Group_Specification(node)
-
-        for node in nx_structure.xpath('//field'):
-            Field_Specification(node)
-
-        for node in nx_structure.xpath('//PV'):
-            PV_Specification(node)
-
-        for node in nx_structure.xpath('//link'):
-            Link_Specification(node)
+        if self.config is None:
+            self.config = ScanConfiguration(self.config_file)
+        else:
+            self.config_file = self.config.config_file
+
+        self.creator_version = self.config.creator_version
+        self.trigger_pv = self.config.trigger_pv
+        self.trigger_accepted_values = self.config.trigger_accepted_values
+        self.trigger_wait_mode = self.config.trigger_wait_mode or self.trigger_wait_mode
+        self.timeout_pv = self.config.timeout_pv
+        self.trigger_poll_interval_s = self.config.trigger_poll_interval_s
+        mca_completion = self.config.mca_completion
+        self.mca_data_acceptable_fraction = mca_completion.get('fraction',
+                                                               self.mca_data_acceptable_fraction)
+        self.mca_data_wait_timeout_s = mca_completion.get('timeout_s', self.mca_data_wait_timeout_s)
+        self.mca_data_wait_settle_s = mca_completion.get('settle_s', self.mca_data_wait_settle_s)
 
     def _get_support_code_dir(self):
         return os.path.split(os.path.abspath(__file__))[0]
 
+    def _connect_PVs(self):
+        '''
+        connect all EPICS PVs at once, waiting for the whole set under one deadline
+
+        Every channel is created before any waiting is done so that all the
+        CA searches go out together.  Connection latency (from the start of
+        this phase) is kept in ``self.connect_latency`` (key: PV name), and
+        recorded as "connect" timings (in the file and the timing log), and
+        PVs that did not connect by the deadline are listed in
+        ``self.not_connected``.  The monitored .NORD fields of the MCA and
+        streamed arrays are connected here too, never after the scan.
+        '''
+        t0 = time.time()
+        latency = {}
+
+        def connection_callback(pvname=None, conn=None, **kw):
+            if conn and pvname not in latency:
+                latency[pvname] = time.time() - t0
+
+        for pv_spec in self.config.pvs.values():
+            self.pvs[pv_spec.hdf5_path] = self.backend.PV(pv_spec.pvname,
+                                                          connection_callback=connection_callback)
+        for pvname in self._nord_pvnames():
+            if pvname not in self.nord_pvs:
+                self.nord_pvs[pvname] = self.backend.PV(pvname + '.NORD',
+                                                        callback=self._notify,
+                                                        connection_callback=connection_callback)
+
+        t_end = t0 + self.connection_timeout_s
+        pending = [self._pv(pv_spec) for pv_spec in self.config.pvs.values()] + self.nord_pvs.values()
+        while len(pending) > 0 and time.time() < t_end:
+            time.sleep(self.connection_poll_interval_s)
+            waiting = []
+            for pv in pending:
+                if pv.connected:
+                    # callback may not fire for a channel already connected by another PV object
+                    latency.setdefault(pv.pvname, time.time() - t0)
+                else:
+                    waiting.append(pv)
+            pending = waiting
+
+        self.connect_latency = latency
+        for pvname, latency_s in sorted(latency.items()):
+            self.setup_timings.add('connect', pvname, t0, latency_s)
+        self.not_connected = sorted(set([pv.pvname for pv in pending]))
+        self._report_connections(time.time() - t0)
+        # all the .DESC fields together, so no metadata read waits during the save
+        self.metadata_cache.prefetch([self._pv(pv_spec) for pv_spec in self.config.pvs.values()],
+                                     self.backend)
+
+    def _report_connections(self, elapsed):
+        '''report the results of the connection phase'''
+        msg = "connected %d of %d PVs" % (len(self.connect_latency),
+                                          len(self.connect_latency) + len(self.not_connected))
+        msg += " in %.3f s" % elapsed
+        if len(self.connect_latency) > 0:
+            slowest = max(self.connect_latency, key=self.connect_latency.get)
+            msg += ", slowest: %s (%.3f s)" % (slowest, self.connect_latency[slowest])
+        print(msg)
+        if self.verbose:
+            for pvname, latency_s in sorted(self.connect_latency.items(), key=lambda item: item[1]):
+                print("  %-40s %7.3f s" % (pvname, latency_s))
+        if len(self.not_connected) > 0:
+            print("PVs not connected: \n* " + '\n* '.join(self.not_connected))
+
     def _prepare_to_acquire(self):
         '''connect to EPICS and create the HDF5 file and structure'''
-        # connect to EPICS PVs
-        for pv_spec in pv_registry.values():
-            pv_spec.pv = epics.PV(pv_spec.pvname)
-
-        # create the file
-        for key, xture in sorted(group_registry.items()):
+        # connect to EPICS PVs, the writer starts only after this
+        with self.setup_timings.measure('phase', 'connect'):
+            self._connect_PVs()
+        if self.hdf5_file_name is not None:
+            self._create_file()
+
+    def _create_file(self):
+        '''start the writer thread, create the HDF5 file and structure, start its timings'''
+        self.closeFile()        # any file left open by an earlier exception
+        self.timings = SaveTimings()
+        self.timings.extend(self.setup_timings)     # setup is reported with the first file only
+        self.setup_timings = SaveTimings()
+        self.writer = HDF5Writer()
+        with self.timings.measure('phase', 'create_file'):
+            self.writer.call(self._create_structure)
+
+    def _create_structure(self):
+        '''(writer thread) create the HDF5 file, its groups and fields'''
+        self.hdf5_groups = {}
+        for key, xture in sorted(self.config.groups.items()):
             if key == '/':
                 # create the file and internal structure
                 f = eznx.makeFile(self.hdf5_file_name,
@@ -400,25 +1568,24 @@ class SaveFlyScan(object):
                   HDF5_Version = h5py.version.hdf5_version,
                   h5py_version = h5py.version.version,
                 )
-                xture.hdf5_group = f
+                self.hdf5_groups[key] = f
+                self.writer.hdf5_file = f
             else:
-                hdf5_parent = xture.group_parent.hdf5_group
-                xture.hdf5_group = eznx.makeGroup(hdf5_parent, xture.name, xture.nx_class)
-            eznx.addAttributes(xture.hdf5_group, **xture.attrib)
+                hdf5_parent = self._parent_group(xture)
+                self.hdf5_groups[key] = eznx.makeGroup(hdf5_parent, xture.name, xture.nx_class)
+            eznx.addAttributes(self.hdf5_groups[key], **xture.attrib)
 
-        for field in field_registry.values():
-            ds = eznx.makeDataset(field.group_parent.hdf5_group, field.name, [field.text])
+        for field in self.config.fields.values():
+            ds = eznx.makeDataset(self._parent_group(field), field.name, [field.text])
             eznx.addAttributes(ds, **field.attrib)
 
-    def _attachEpicsAttributes(self, node, pv):
-        '''attach common attributes from EPICS to the HDF5 tree node'''
-        pvname = os.path.splitext(pv.pvname)[0]
-        desc = epics.caget(pvname+'.DESC') or ''
+    def _attachEpicsAttributes(self, node, pv, metadata):
+        '''attach common attributes from EPICS (metadata from the cache) to the HDF5 tree node'''
         eznx.addAttributes(node,
           epics_pv = pv.pvname,
-          units = pv.units or '',
-          epics_type = pv.type,
-          epics_description = desc,
+          units = str(metadata['units']),
+          epics_type = str(metadata['type']),
+          epics_description = str(metadata['desc']),
         )
 
 
@@ -434,12 +1601,41 @@ def get_CLI_options():
                     action='store',
                     help="XML configuration file")
 
+    parser.add_argument('--stream',
+                    action='store_true',
+                    default=False,
+                    help="write PVs marked stream=\"true\" while the scan runs")
+
+    parser.add_argument('--invalidate-metadata',
+                    action='store_true',
+                    default=False,
+                    help="re-read EPICS metadata (.DESC, units, type) for all PVs")
+
+    parser.add_argument('--timing-log',
+                    action='store',
+                    default=None,
+                    help="append the timings of the save as a JSON line to this file")
+
+    parser.add_argument('--write-ahead',
+                    action='store_true',
+                    default=False,
+                    help="flush the file after each phase and record the completed phases")
+
+    parser.add_argument('--recover',
+                    action='store_true',
+                    default=False,
+                    help="finish data_file, left incomplete by an interrupted --write-ahead save")
+
+    parser.add_argument('--verbose',
+                    action='store_true',
+                    default=False,
+                    help="report the connect latency of each PV")
+
     return parser.parse_args()
 
 
-def main():
-    cli_options = get_CLI_options()
-    dataFile = cli_options.data_file
+def check_data_file(dataFile):
+    '''raise RuntimeError if a new data file cannot be written with this name'''
     path = os.path.split(dataFile)[0]
     if len(path) > 0 and not os.path.exists(path):
         msg = 'directory for that file does not exist: ' + dataFile
@@ -449,17 +1645,48 @@ def main():
         msg = 'file exists: ' + dataFile
         raise RuntimeError, msg
 
+
+def main():
+    cli_options = get_CLI_options()
+    dataFile = cli_options.data_file
+    if cli_options.recover:
+        if not os.path.exists(dataFile):
+            msg = 'file not found: ' + dataFile
+            raise RuntimeError, msg
+    else:
+        check_data_file(dataFile)
+
     configFile = cli_options.xml_config_file
     if not os.path.exists(configFile):
         msg = 'config file not found: ' + configFile
         raise RuntimeError, msg
 
-    sfs = SaveFlyScan(dataFile, configFile)
+    metadata_cache = EpicsMetadataCache()
+    if cli_options.invalidate_metadata:
+        metadata_cache.invalidate()
+
+    if cli_options.recover:
+        sfs = SaveFlyScan(None, configFile, metadata_cache=metadata_cache,
+                          verbose=cli_options.verbose)
+        try:
+            written = sfs.recoverFile(dataFile)
+        finally:
+            sfs.closeFile()
+        print 'recovered file: %s (%d PVs written)' % (dataFile, len(written))
+        return
+
+    sfs = SaveFlyScan(dataFile, configFile, metadata_cache=metadata_cache,
+                      verbose=cli_options.verbose)
+    sfs.streaming = cli_options.stream
+    sfs.timing_log = cli_options.timing_log
+    sfs.write_ahead = cli_options.write_ahead
     try:
         sfs.waitForData()
     except TimeoutException, _exception_message:
         print "exiting because of timeout!!!!!!!"
         sys.exit(1)     # exit silently with error, 1=TIMEOUT
+    finally:
+        sfs.closeFile()
     print 'wrote file: ' + dataFile
 
 
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+
+
+'''
+in-process simulation of the EPICS PVs used by saveFlyData.py, driven by a scenario
+
+Use it as the backend of SaveFlyScan to run a complete fly scan
+save without the 9-ID-C IOCs::
+
+  import saveFlyData, simEpics
+  backend = simEpics.SimulatedBackend('scenario.json')
+  sfs = saveFlyData.SaveFlyScan('test.h5', 'saveFlyData.xml', backend=backend)
+  sfs.waitForData()
+
+The scenario (a JSON file or a dictionary) overrides any of the
+keys of ``DEFAULT_SCENARIO``:
+
+=====================  ==============================================================
+key                    meaning
+=====================  ==============================================================
+connect_delay_s        connection delay of any PV not in ``connect_delays``
+connect_delays         {pvname: delay_s} connection delay of slow PVs
+never_connect          [pvname, ...] PVs that never connect
+values                 {pvname: value} initial values of PVs (default: 0.0)
+trigger_pv             PV that goes Busy (1) at start of scan, Done (0) at end
+not_saved_pv           the scan starts when this PV is set to 1 (by SaveFlyScan)
+channel_pv             reports the number of MCA channels at the end of the scan
+scan_time_s            length of the (simulated) fly scan
+update_interval_s      the arrays grow (and post .NORD monitors) at this interval
+channels               number of MCA channels collected by the scan
+arrays                 [pvname, ...] arrays that grow during the scan
+=====================  ==============================================================
+'''
+
+
+import copy
+import json
+import threading
+import time
+
+import numpy
+
+
+AUTOMONITOR_MAXLENGTH = 65536       # same as PyEpics: bigger arrays are not monitored
+DEFAULT_SCENARIO = dict(
+    connect_delay_s = 0.001,
+    connect_delays = {},
+    never_connect = [],
+    values = {},
+    trigger_pv = '9idcLAX:USAXSfly:Start',
+    not_saved_pv = '9idcLAX:USAXS:FlyScanNotSaved',
+    channel_pv = '9idcLAX:3820:CurrentChannel',
+    scan_time_s = 1.0,
+    update_interval_s = 0.1,
+    channels = 8000,
+    arrays = ['9idcLAX:3820:mca1', '9idcLAX:3820:mca2', '9idcLAX:3820:mca3'],
+)
+
+
+class SimulatedPV(object):
+    '''an EPICS PV, with the attributes of epics.PV that saveFlyData.py uses'''
+
+    def __init__(self, pvname, value, nelm = 1, callback = None, connection_callback = None):
+        self.pvname = pvname
+        self.value = value
+        self.nelm = nelm
+        self.connected = False
+        self.units = ''
+        self.type = 'double'
+        if isinstance(value, numpy.ndarray):
+            self.type = 'long'
+        elif isinstance(value, str):
+            self.type = 'string'
+        self.auto_monitor = nelm < AUTOMONITOR_MAXLENGTH
+        self.callbacks = []
+        if callback is not None:
+            self.callbacks.append(callback)
+        self.connection_callback = connection_callback
+        self._connected_event = threading.Event()
+
+    @property
+    def count(self):
+        if isinstance(self.value, numpy.ndarray):
+            return len(self.value)
+        return 1
+
+    def get(self, count = None, as_string = False, **kw):
+        value = self.value
+        if isinstance(value, numpy.ndarray) and count is not None:
+            value = value[:count]
+        if as_string:
+            return str(value)
+        return value
+
+    def wait_for_connection(self, timeout = None):
+        return self._connected_event.wait(timeout)
+
+    def _connect(self):
+        self.connected = True
+        self._connected_event.set()
+        if self.connection_callback is not None:
+            self.connection_callback(pvname=self.pvname, conn=True)
+
+    def _post(self, value):
+        '''new value from the simulated IOC, call the monitor callbacks'''
+        self.value = value
+        for callback in self.callbacks:
+            callback(pvname=self.pvname, value=value, char_value=str(value))
+
+
+class SimulatedBackend(object):
+    '''in-process substitute for saveFlyData.PyEpicsBackend'''
+
+    def __init__(self, scenario = None):
+        self.scenario = copy.deepcopy(DEFAULT_SCENARIO)
+        if isinstance(scenario, basestring):
+            with open(scenario, 'r') as fp:
+                scenario = json.load(fp)
+        self.scenario.update(scenario or {})
+        self.values = {}        # key: pvname, value: current (simulated IOC) value
+        self.pvs = {}           # key: pvname, value: list of SimulatedPV
+        self.scan_thread = None
+        self.reset()
+
+    def reset(self):
+        '''initial values (before the scan) of every PV in the scenario'''
+        for pvname, value in self.scenario['values'].items():
+            self._set(pvname, value)
+        self._clear_arrays()
+        self._set(self.scenario['trigger_pv'], 0)
+
+    def _clear_arrays(self):
+        for pvname in self.scenario['arrays']:
+            self._set(pvname, numpy.zeros((0,), dtype=numpy.int32))
+            self._set(pvname + '.NORD', 0)
+
+    def PV(self, pvname, callback = None, connection_callback = None, **kw):
+        value = self.values.get(pvname, 0.0)
+        nelm = 1
+        if pvname in self.scenario['arrays']:
+            nelm = max(self.scenario['channels'], 1)
+        pv = SimulatedPV(pvname, value, nelm, callback, connection_callback)
+        self.pvs.setdefault(pvname, []).append(pv)
+        if pvname not in self.scenario['never_connect']:
+            delay = self.scenario['connect_delays'].get(pvname, self.scenario['connect_delay_s'])
+            timer = threading.Timer(delay, pv._connect)
+            timer.daemon = True
+            timer.start()
+        return pv
+
+    def caget(self, pvname, **kw):
+        if pvname.endswith('.DESC'):
+            return 'simulated ' + pvname[:-len('.DESC')]
+        return self.values.get(pvname, 0.0)
+
+    def caget_many(self, pvnames, timeout = None):
+        return dict([(pvname, self.caget(pvname)) for pvname in pvnames])
+
+    def caput(self, pvname, value, **kw):
+        self._set(pvname, value)
+        if pvname == self.scenario['not_saved_pv'] and value == 1:
+            self.start_scan()
+        return 1
+
+    def request(self, pv, count = None):
+        pass
+
+    def complete(self, pv, count = None, as_string = False, timeout = None):
+        return pv.get(count=count, as_string=as_string)
+
+    def read(self, pv, count = None, timeout = None):
+        return pv.get(count=count)
+
+    def request_units(self, pv):
+        pass
+
+    def complete_units(self, pv, timeout = None):
+        return pv.units
+
+    def start_scan(self):
+        '''trigger goes Busy, the arrays grow, then trigger goes Done'''
+        self._clear_arrays()
+        self._set(self.scenario['trigger_pv'], 1)
+        self.scan_thread = threading.Thread(target=self._scan)
+        self.scan_thread.daemon = True
+        self.scan_thread.start()
+
+    def _scan(self):
+        channels = self.scenario['channels']
+        t0 = time.time()
+        t_end = t0 + self.scenario['scan_time_s']
+        data = dict([(pvname, numpy.random.randint(0, 100000, channels).astype(numpy.int32))
+                     for pvname in self.scenario['arrays']])
+        while True:
+            now = time.time()
+            fraction = min(1.0, (now - t0) / max(self.scenario['scan_time_s'], 1e-6))
+            n = int(channels * fraction)
+            for pvname, array in data.items():
+                self._set(pvname, array[:n])
+                self._set(pvname + '.NORD', n)
+            if now >= t_end:
+                break
+            time.sleep(min(self.scenario['update_interval_s'], max(t_end - now, 0)))
+        self._set(self.scenario['channel_pv'], channels)
+        self._set(self.scenario['trigger_pv'], 0)
+
+    def _set(self, pvname, value):
+        self.values[pvname] = value
+        for pv in self.pvs.get(pvname, []):
+            pv._post(value)
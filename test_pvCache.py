@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+'''
+unit tests of pvCache, with a stand-in for epics.PV (no IOC needed)::
+
+  python test_pvCache.py
+'''
+
+
+import sys
+import types
+import unittest
+
+
+class FakePV(object):
+    '''epics.PV stand-in: the test calls connect(), post(), and disconnect()'''
+
+    def __init__(self, pvname, form = None, callback = None, connection_callback = None):
+        self.pvname = pvname
+        self.callback = callback
+        self.connection_callback = connection_callback
+
+    def connect(self, value):
+        self.connection_callback(pvname=self.pvname, conn=True)
+        self.post(value)
+
+    def post(self, value):
+        self.callback(pvname=self.pvname, value=value, char_value=str(value),
+                      timestamp=0.0, severity=0)
+
+    def disconnect(self):
+        self.connection_callback(pvname=self.pvname, conn=False)
+
+    def clear_callbacks(self):
+        pass
+
+
+if 'epics' not in sys.modules:
+    sys.modules['epics'] = types.ModuleType('epics')
+sys.modules['epics'].PV = FakePV
+import pvCache
+
+
+class TestPVCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = pvCache.PVCache()
+
+    def test_value_from_monitor(self):
+        self.cache.channel('test:a').pv.connect(1.5)
+        self.assertEqual(self.cache.get('test:a', timeout=0), 1.5)
+        self.assertEqual(self.cache.get('test:a', as_string=True, timeout=0), '1.5')
+
+    def test_disconnect_drops_value(self):
+        pv = self.cache.channel('test:a').pv
+        pv.connect(1.5)
+        self.cache.channel('test:b').pv.connect(2.5)
+        pv.disconnect()
+        self.assertEqual(self.cache.get('test:a', timeout=0), None)
+        values = self.cache.get_many(['test:a', 'test:b'], timeout=0)
+        self.assertEqual(sorted(values), ['test:b'])
+        self.assertEqual(self.cache.statistics()['disconnects'], 1)
+
+        pv.connect(3.5)     # the monitor sends the value again on reconnect
+        self.assertEqual(self.cache.get('test:a', timeout=0), 3.5)
+
+    def test_connection_callback(self):
+        events = []
+        self.cache.subscribe_connection('test:a', lambda pvname=None, conn=None, **kw: events.append(conn))
+        pv = self.cache.channel('test:a').pv
+        pv.connect(1.5)
+        pv.disconnect()
+        pv.connect(2.5)
+        self.assertEqual(events, [True, False, True])
+
+    def test_never_connected(self):
+        self.cache.channel('test:c')
+        self.assertEqual(self.cache.get_many(['test:c'], timeout=0), {})
+        self.assertEqual(self.cache.statistics()['never_connected'], ['test:c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+'''
+unit tests of saveFlyData.StreamingPV, with stand-ins for EPICS and HDF5 (no IOC needed)::
+
+  python test_saveFlyData.py
+'''
+
+
+import unittest
+
+import numpy
+
+import saveFlyData
+
+
+class FakeNordPV(object):
+    '''.NORD monitor stand-in: the test sets ``value``'''
+
+    def __init__(self, value = 0):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+class FakeBackend(object):
+    '''reads ``count`` elements of ``array``'''
+
+    def __init__(self, array):
+        self.array = array
+        self.reads = 0
+
+    def read(self, pv, count = None, timeout = None):
+        self.reads += 1
+        return self.array[:count]
+
+
+class FakeWriter(object):
+    '''HDF5Writer stand-in: runs each write at once'''
+
+    def submit(self, function, *args, **kw):
+        function(*args, **kw)
+
+
+class FakeDataset(object):
+
+    def __init__(self, data):
+        self.data = numpy.array(data)
+
+    def resize(self, shape):
+        data = numpy.zeros(shape, dtype=self.data.dtype)
+        n = min(len(data), len(self.data))
+        data[:n] = self.data[:n]
+        self.data = data
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+
+class FakeGroup(object):
+
+    def create_dataset(self, name, data = None, **kw):
+        return FakeDataset(data)
+
+
+class FakeSpec(object):
+    pvname = 'test:mca1'
+    label = 'mca1'
+    storage = {}
+
+
+class TestStreamingPV(unittest.TestCase):
+
+    def setUp(self):
+        self.array = numpy.arange(8000, dtype='uint32')
+        self.nord_pv = FakeNordPV()
+        self.backend = FakeBackend(self.array)
+        self.stream = saveFlyData.StreamingPV(FakeSpec(), None, self.nord_pv, FakeGroup(),
+                                              self.backend, FakeWriter())
+
+    def test_stream_and_finish(self):
+        self.nord_pv.value = 3000
+        self.stream.update()
+        self.nord_pv.value = 8000
+        self.stream.finish()
+        self.assertEqual(list(self.stream.dataset.data), list(self.array))
+        self.assertEqual(self.stream.restarts, 0)
+
+    def test_nord_above_length_limit(self):
+        self.nord_pv.value = 8000
+        self.stream.update()
+        reads = self.backend.reads
+        self.stream.finish(length_limit=5000)
+        self.assertEqual(self.stream.restarts, 0)
+        self.assertEqual(self.backend.reads, reads)     # not read again
+        self.assertEqual(list(self.stream.dataset.data), list(self.array[:5000]))
+
+    def test_nord_shrank(self):
+        self.nord_pv.value = 8000
+        self.stream.update()
+        self.nord_pv.value = 4000
+        self.stream.finish()
+        self.assertEqual(self.stream.restarts, 1)
+        self.assertEqual(list(self.stream.dataset.data), list(self.array[:4000]))
+
+
+if __name__ == '__main__':
+    unittest.main()